@@ -2,11 +2,501 @@
 ### Lamba function (see handler) which returns a listener rule priority for the a new/existing service, used for your custom backed lambda resource ### 
 ### Repository at http://github.com/minimice ###
 
-import boto3
-import json
 import time
-from botocore.vendored import requests
+_init_started = time.perf_counter()
+
+import abc
+import functools
+import hashlib
+import json
+import os
+import random
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Maximum page size accepted by describe_rules
+# see https://docs.aws.amazon.com/elasticloadbalancing/latest/APIReference/API_DescribeRules.html
+DESCRIBE_RULES_PAGE_SIZE = 400
+
+# Highest priority a listener rule can have
+# see https://docs.aws.amazon.com/elasticloadbalancing/latest/APIReference/API_CreateRule.html
+MAX_RULE_PRIORITY = 50000
+
+# How a new service's priority is picked, see allocate_priority
+# lowest: the lowest free priority
+# hash: the first free priority from a slot picked by a stable hash of the service name, which spreads
+#       concurrent deploys across the priority space and gives a recreated service its old priority back
+ALLOCATION_STRATEGIES = ('lowest', 'hash')
+
+# DynamoDB table holding priority reservations, see DynamoDBReservationStore
+RESERVATION_TABLE = os.environ.get('RESERVATION_TABLE', '')
+
+# How long a reservation is held, it only has to outlive the creation of the listener rule
+RESERVATION_TTL_SECONDS = int(os.environ.get('RESERVATION_TTL_SECONDS', '3600'))
+
+# How long, and for how many listeners, a warm Lambda container keeps listener rules, see ListenerCache
+LISTENER_CACHE_TTL_SECONDS = float(os.environ.get('LISTENER_CACHE_TTL_SECONDS', '30'))
+LISTENER_CACHE_MAX_ENTRIES = int(os.environ.get('LISTENER_CACHE_MAX_ENTRIES', '32'))
+
+# Rules a load balancer of a listener_pool can hold across its listeners, the default quota of rules per application load balancer
+# see https://docs.aws.amazon.com/elasticloadbalancing/latest/application/load-balancer-limits.html
+LISTENER_RULE_QUOTA = int(os.environ.get('LISTENER_RULE_QUOTA', '100'))
+
+# PhysicalResourceIds made by this Lambda start with this, see encode_physical_resource_id
+PHYSICAL_RESOURCE_ID_PREFIX = 'listener-rule-priority'
+
+# Threads reading listeners side by side when a request has more than one listener
+LISTENER_FETCH_WORKERS = int(os.environ.get('LISTENER_FETCH_WORKERS', '4'))
+
+# DEBUG also logs every priority in use on the listener, thousands of integers per call on a large listener
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# CloudWatch namespace of the metrics logged once per invocation, see InvocationMetrics
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ListenerRulePriority')
+
+# Timeouts and attempts when sending the response to CloudFormation, see ResponseSender
+# Kept well inside the 30 second Lambda timeout so a failed send is still logged
+RESPONSE_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('RESPONSE_CONNECT_TIMEOUT_SECONDS', '2'))
+RESPONSE_READ_TIMEOUT_SECONDS = float(os.environ.get('RESPONSE_READ_TIMEOUT_SECONDS', '4'))
+RESPONSE_MAX_ATTEMPTS = int(os.environ.get('RESPONSE_MAX_ATTEMPTS', '3'))
+
+# CloudFormation rejects a response body larger than this
+# see https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/crpg-ref-responses.html
+MAX_RESPONSE_BYTES = 4096
+
+# boto3 clients, created on first use and re-used for the life of the container
+_clients = {}
+_clients_lock = threading.Lock()
+
+#### Returns a boto3 client for the service, boto3 is only imported when a client is first needed ####
+def get_client(service_name):
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+    with _clients_lock:
+        if service_name not in _clients:
+            started = time.perf_counter()
+            import boto3
+            _clients[service_name] = boto3.client(service_name)
+            print("Init: created " + service_name + " client in " + format_ms(time.perf_counter() - started))
+    return _clients[service_name]
+
+#### Formats a duration in seconds as milliseconds ####
+def format_ms(seconds):
+    return str(round(seconds * 1000, 1)) + " ms"
+
+#### Metrics of one invocation ####
+class InvocationMetrics:
+    """
+    Phase timings and counters of the current invocation, logged by emit() as one line in CloudWatch
+    embedded metric format, which CloudWatch turns into metrics without the Lambda calling its API.
+    Counters can be added to from the threads reading listeners side by side.
+    """
+
+    # Metrics and their units, anything else in the line (RequestType, Strategy, Status) is a property
+    UNITS = {
+        'SnapshotFetchMs': 'Milliseconds',
+        'IndexBuildMs': 'Milliseconds',
+        'AllocationMs': 'Milliseconds',
+        'ResponseSendMs': 'Milliseconds',
+        'TotalMs': 'Milliseconds',
+        'Elbv2Calls': 'Count',
+        'ListenerCacheHits': 'Count',
+        'AllocationAttempts': 'Count',
+        'ResponseAttempts': 'Count',
+        'RuleCount': 'Count',
+        'Services': 'Count'
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, request_type='None'):
+        with self._lock:
+            self._started = time.perf_counter()
+            self.values = { 'RequestType': request_type }
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self.values[name] = value
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent in the with block to name, in milliseconds
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000)
+
+    def emit(self):
+        with self._lock:
+            values = dict(self.values)
+        values['TotalMs'] = (time.perf_counter() - self._started) * 1000
+        for name, value in values.items():
+            if isinstance(value, float):
+                values[name] = round(value, 3)
+        values['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['RequestType']],
+                'Metrics': [{ 'Name': name, 'Unit': unit } for name, unit in sorted(self.UNITS.items()) if name in values]
+            }]
+        }
+        print(json.dumps(values, separators=(',', ':'), sort_keys=True))
+
+_metrics = InvocationMetrics()
+
+#### Wraps a Lambda handler so every invocation logs its metrics line, however it returns ####
+def instrumented(handler_function):
+    @functools.wraps(handler_function)
+    def wrapper(event, context):
+        _metrics.reset(str(event.get('RequestType', 'Api')) if isinstance(event, dict) else 'Api')
+        try:
+            result = handler_function(event, context)
+            if isinstance(result, dict) and 'statusCode' in result:
+                _metrics.set('Status', result['statusCode'])
+            return result
+        finally:
+            _metrics.emit()
+    return wrapper
+
+#### Index of the free rule priorities of a listener ####
+class FreePriorityIndex:
+    """
+    One byte per priority in 1..MAX_RULE_PRIORITY, zero when the priority is free.
+    Building it is a single pass over the priorities in use (no sorting), and every query is one
+    bytearray.find which scans in C, so lookups stay cheap when a listener carries thousands of rules.
+    All queries return -1 when nothing free is found.
+    """
+
+    def __init__(self, used=()):
+        self._slots = bytearray(MAX_RULE_PRIORITY + 1)
+        # 0 is not a valid priority
+        self._slots[0] = 1
+        for priority in used:
+            self.reserve(priority)
+
+    def reserve(self, priority):
+        if 1 <= priority <= MAX_RULE_PRIORITY:
+            self._slots[priority] = 1
+
+    def release(self, priority):
+        if 1 <= priority <= MAX_RULE_PRIORITY:
+            self._slots[priority] = 0
+
+    def used_count(self):
+        return self._slots.count(1) - 1
+
+    def is_free(self, priority):
+        return 1 <= priority <= MAX_RULE_PRIORITY and self._slots[priority] == 0
+
+    def first_free(self, start=1, end=MAX_RULE_PRIORITY):
+        """
+        Returns the lowest free priority >= start, or inside the band [start, end]
+        """
+        start = max(start, 1)
+        end = min(end, MAX_RULE_PRIORITY)
+        if start > end:
+            return -1
+        return self._slots.find(0, start, end + 1)
+
+    @classmethod
+    def intersect(cls, indexes):
+        """
+        Returns an index of the priorities free in all of the indexes, a single index is returned as is
+        """
+        if len(indexes) == 1:
+            return indexes[0]
+        # Slots are 0 or 1, so OR-ing the slots as one big integer ORs them byte by byte
+        used = 0
+        for index in indexes:
+            used |= int.from_bytes(index._slots, 'big')
+        merged = cls()
+        merged._slots = bytearray(used.to_bytes(MAX_RULE_PRIORITY + 1, 'big'))
+        return merged
+
+#### Index of the host and path conditions of a listener's rules ####
+class RuleConditionIndex:
+    """
+    Maps the host-header and path-pattern values of every rule, across all of its conditions, to the rule,
+    and each priority back to the service (host) owning it. Lookups are dictionary reads.
+    When several rules match the same key the lowest priority wins, as it does on the load balancer.
+    """
+
+    def __init__(self, rules=()):
+        self.by_host_path = {}
+        self.service_by_priority = {}
+        for rule in rules:
+            if rule['Priority'].isdigit():
+                hosts, paths = get_condition_values(rule)
+                self.add(rule['RuleArn'], int(rule['Priority']), hosts, paths)
+
+    def add(self, rule_arn, priority, hosts, paths):
+        match = (rule_arn, priority)
+        for host in hosts:
+            # A rule without a path condition is stored under a path of None
+            for path in (paths or [None]):
+                self._keep_lowest(self.by_host_path, (host, path), match)
+        if hosts and priority not in self.service_by_priority:
+            self.service_by_priority[priority] = hosts[0]
+
+    def lookup(self, host, path=None):
+        """
+        Returns (rule_arn, priority) of the rule for the host and path, or None.
+        Without a path, only a rule with no path condition matches, a host+path rule belongs to another service.
+        """
+        return self.by_host_path.get((host, path))
+
+    @staticmethod
+    def _keep_lowest(index, key, match):
+        if key not in index or match[1] < index[key][1]:
+            index[key] = match
+
+#### Returns the host-header and path-pattern values of a rule ####
+def get_condition_values(rule):
+    hosts = []
+    paths = []
+    for condition in rule.get('Conditions', []):
+        field = condition.get('Field')
+        if field == 'host-header':
+            values, config = hosts, condition.get('HostHeaderConfig', {})
+        elif field == 'path-pattern':
+            values, config = paths, condition.get('PathPatternConfig', {})
+        else:
+            continue
+        # Values is the legacy form, the *Config form allows more than one value
+        for value in condition.get('Values', []) + config.get('Values', []):
+            if value not in values:
+                values.append(value)
+    return hosts, paths
+
+#### Snapshot of every rule on a listener, read once per invocation ####
+class ListenerRuleSnapshot:
+    """
+    All rules of a listener, read through every describe_rules page.
+    Both the host lookup and the free priority search read from this instead of calling elbv2 themselves.
+    """
+
+    def __init__(self, listener_arn, rules, api_calls=0):
+        self.listener_arn = listener_arn
+        self.rules = rules
+        self.api_calls = api_calls
+        # Numeric priorities only, the default rule has priority 'default'
+        self.priorities = [int(rule['Priority']) for rule in rules if rule['Priority'].isdigit()]
+        self._free_index = None
+        self._condition_index = None
+        # Priorities handed out by this Lambda since, by (service_name, path), apart from the rules read
+        self.allocations = {}
+
+    @classmethod
+    def fetch(cls, client, listener_arn):
+        """
+        Pages through describe_rules (following NextMarker) and returns a snapshot of the listener
+        """
+        rules = []
+        api_calls = 0
+        kwargs = { 'ListenerArn': listener_arn, 'PageSize': DESCRIBE_RULES_PAGE_SIZE }
+        while True:
+            response = client.describe_rules(**kwargs)
+            api_calls = api_calls + 1
+            rules.extend(response['Rules'])
+            if not response.get('NextMarker'):
+                break
+            kwargs['Marker'] = response['NextMarker']
+        return cls(listener_arn, rules, api_calls)
+
+    def free_index(self):
+        """
+        Returns the free priority index of this snapshot, built on first use
+        """
+        if self._free_index is None:
+            with _metrics.phase('IndexBuildMs'):
+                self._free_index = FreePriorityIndex(self.priorities)
+        return self._free_index
+
+    def condition_index(self):
+        """
+        Returns the host/path condition index of this snapshot, built on first use
+        """
+        if self._condition_index is None:
+            with _metrics.phase('IndexBuildMs'):
+                self._condition_index = RuleConditionIndex(self.rules)
+        return self._condition_index
+
+    def rule_count(self):
+        """
+        Returns the number of rules on the listener, counting priorities this Lambda handed out
+        """
+        return self.free_index().used_count()
+
+    def record_allocation(self, priority, service_name, path=None):
+        """
+        Marks a priority handed out by this Lambda as in use, as if its listener rule already existed.
+        The service only gets it back from get_service_priority, the condition index keeps to the rules read.
+        """
+        if priority > MAX_RULE_PRIORITY:
+            return
+        self.free_index().reserve(priority)
+        self.allocations.setdefault((service_name, path or None), priority)
+
+#### Priority reservations ####
+class PriorityReservationStore(abc.ABC):
+    """
+    Leases a (listener_arn, priority) pair to a service for ttl seconds.
+    reserve() must be atomic: it only succeeds when the priority is not leased, the lease has expired,
+    or the lease is already held by the same service (so a retried request gets its priority back).
+    shared is False for a store other Lambda containers cannot see, which the handler refuses to allocate new priorities with.
+    """
+
+    shared = True
+
+    @abc.abstractmethod
+    def reserve(self, listener_arn, priority, service_name, ttl):
+        """
+        Returns True if the priority is now leased to the service until ttl seconds from now
+        """
+
+    @abc.abstractmethod
+    def release(self, listener_arn, priority, service_name):
+        """
+        Ends the service's lease of the priority, a lease held by another service is left alone
+        """
+
+class InMemoryReservationStore(PriorityReservationStore):
+    """
+    Reservations held in this process only. Tests share one between callers as a stand-in for the table,
+    the one used when no reservation table is configured is not shared with other containers.
+    """
+
+    def __init__(self, shared=True):
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._leases = {}
+
+    def reserve(self, listener_arn, priority, service_name, ttl):
+        now = time.time()
+        with self._lock:
+            lease = self._leases.get((listener_arn, priority))
+            if lease is not None and lease[1] >= now and lease[0] != service_name:
+                return False
+            self._leases[(listener_arn, priority)] = (service_name, now + ttl)
+            return True
+
+    def release(self, listener_arn, priority, service_name):
+        with self._lock:
+            lease = self._leases.get((listener_arn, priority))
+            if lease is not None and lease[0] == service_name:
+                del self._leases[(listener_arn, priority)]
+
+class DynamoDBReservationStore(PriorityReservationStore):
+    """
+    Reservations held in a DynamoDB table keyed on listener_arn (hash) and priority (range),
+    with expires_at as the table's TTL attribute. A reservation is one conditional put_item.
+    """
+
+    def __init__(self, table_name, client):
+        self.table_name = table_name
+        self.client = client
+
+    def reserve(self, listener_arn, priority, service_name, ttl):
+        now = int(time.time())
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'listener_arn': { 'S': listener_arn },
+                    'priority': { 'N': str(priority) },
+                    'service_name': { 'S': service_name },
+                    'expires_at': { 'N': str(now + ttl) }
+                },
+                # TTL deletes lag behind expiry, so check expires_at ourselves
+                ConditionExpression='attribute_not_exists(listener_arn) OR expires_at < :now OR service_name = :service_name',
+                ExpressionAttributeValues={
+                    ':now': { 'N': str(now) },
+                    ':service_name': { 'S': service_name }
+                }
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release(self, listener_arn, priority, service_name):
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key={
+                    'listener_arn': { 'S': listener_arn },
+                    'priority': { 'N': str(priority) }
+                },
+                ConditionExpression='service_name = :service_name',
+                ExpressionAttributeValues={ ':service_name': { 'S': service_name } }
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass # Held by another service, leave it alone
+
+#### Listener snapshots kept by a warm Lambda container ####
+class ListenerCache:
+    """
+    Size bounded LRU of listener snapshots (and the indexes built on them) keyed by listener ARN,
+    so a burst of deploys against the same listener reads its rules once per container.
+    Entries expire after ttl seconds. Priorities handed out by this container are written through
+    into the cached snapshot (see ListenerRuleSnapshot.record_allocation), so they are never handed out twice.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, client, listener_arn):
+        """
+        Returns the cached snapshot of the listener, reading the listener rules if there is none or it has expired
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(listener_arn)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(listener_arn)
+                _metrics.add('ListenerCacheHits')
+                return entry[0]
+
+        snapshot = ListenerRuleSnapshot.fetch(client, listener_arn)
+        _metrics.add('Elbv2Calls', snapshot.api_calls)
 
+        with self._lock:
+            self._entries[listener_arn] = (snapshot, now + self.ttl)
+            self._entries.move_to_end(listener_arn)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return snapshot
+
+_listener_cache = ListenerCache(LISTENER_CACHE_MAX_ENTRIES, LISTENER_CACHE_TTL_SECONDS)
+
+_reservation_store = None
+
+#### Returns the reservation store, DynamoDB when RESERVATION_TABLE is set ####
+def get_reservation_store():
+    global _reservation_store
+    if _reservation_store is None:
+        if RESERVATION_TABLE:
+            _reservation_store = DynamoDBReservationStore(RESERVATION_TABLE, get_client('dynamodb'))
+        else:
+            print("RESERVATION_TABLE is not set, new rule priorities cannot be reserved")
+            _reservation_store = InMemoryReservationStore(shared=False)
+    return _reservation_store
+
+@instrumented
 def handler(event, context):
 
     # Sample request returned in the event object
@@ -32,126 +522,455 @@ def handler(event, context):
     # Check request type
     request_type = event['RequestType']
 
-    # Return success immediately if deleting
+    # Release any reservation and return success immediately if deleting
     if event['RequestType'] == 'Delete':
+        release_reservations(event)
         return send_response(event, context, "SUCCESS", {"Message": "Resource deletion successful!"})
 
+    # Nothing changed, answer with the priorities held in the PhysicalResourceId without reading the listeners
+    if event['RequestType'] == 'Update':
+        response_data = get_unchanged_update_data(event)
+        if response_data is not None:
+            print("Properties unchanged, returning the recorded priorities")
+            return send_response(event, context, "SUCCESS", response_data, event['PhysicalResourceId'])
+
     # Otherwise it's a create or update
     resource_properties = event['ResourceProperties']
 
-    # Validation of listener_arn and service_name
-    if 'listener_arn' not in resource_properties or 'service_name' not in resource_properties:
+    # Validation of listener_arn (or listener_pool) and service_name
+    if ('listener_arn' not in resource_properties and 'listener_pool' not in resource_properties) or ('service_name' not in resource_properties and 'service_names' not in resource_properties):
         return send_response(event, context, "FAILED", {"Message": "Missing listener_arn and service_name parameters from CloudFormation"})
 
     # Json test nested under ResourceProperties
     # {"listener_arn": "arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-infra-ecs-dev/1234/5678","service_name": "lcg-fakeservice.lcg.com"}
-    listener_arn = resource_properties['listener_arn']
-    service_name = resource_properties['service_name']
-    
-    # Look for the service priority in the listener if it already exists
-    service_priority = get_service_priority(service_name, listener_arn)
-
-    # Service already exists, re-use the same priority
-    if service_priority != -1:
-        print("Found existing service, returning " + str(service_priority))
-        return send_response(event, context, "SUCCESS", ({ 'priority': '' + str(service_priority) +'' }))
-
-    # Find a new rule priority for the new service (preliminary)
-    service_priority_preliminary = get_next_avail_priority(listener_arn)
+    # or for many services in one call
+    # {"listener_arn": "...", "service_names": ["lcg-fakeservice.lcg.com", {"name": "fakeapi", "service_name": "lcg-fakeapi.lcg.com", "path": "/api/*"}]}
+    # or for a priority free on several listeners, e.g. the HTTP and HTTPS listeners of a load balancer
+    # {"listener_arn": ["...", "..."], "service_name": "lcg-fakeservice.lcg.com"}
+    # or for the least loaded listener of a pool of load balancers, returned as listener_arn
+    # {"listener_pool": ["...", "..."], "service_name": "lcg-fakeservice.lcg.com"}
+    # allocation_strategy (lowest or hash) and priority_band (e.g. "1000-1999") are optional in all cases
+    try:
+        services = get_requested_services(resource_properties)
+        strategy, band = get_allocation_options(resource_properties)
+        if 'listener_pool' in resource_properties:
+            sticky, rule_quota = get_pool_options(resource_properties)
+    except ValueError as err:
+        return send_response(event, context, "FAILED", {"Message": str(err)})
 
-    # Wait 5 seconds and see if the priority has changed, if it has this means that the new service priority is now in use and we need to return a new one
-    time.sleep(5)
+    client = get_client('elbv2')
+    _metrics.set('Strategy', strategy)
+    _metrics.set('Services', len(services))
 
-    # Find a new rule priority for the new service (preliminary)
-    service_priority_final = get_next_avail_priority(listener_arn)
+    # Read all the listener rules once (or re-use them if this container read them recently),
+    # every service below is allocated off these snapshots
+    if 'listener_pool' in resource_properties:
+        with _metrics.phase('SnapshotFetchMs'):
+            pool_snapshots = get_listener_snapshots(client, resource_properties['listener_pool'])
+        snapshot = choose_pool_listener(pool_snapshots, services, sticky, rule_quota)
+        if snapshot is None:
+            return send_response(event, context, "FAILED", {"Message": "Every load balancer in listener_pool has reached its rule quota of " + str(rule_quota) + ", add a load balancer to the pool"})
+        print("Using listener " + snapshot.listener_arn + " from listener_pool")
+        snapshots = [snapshot]
+    else:
+        listener_arn = resource_properties['listener_arn']
+        listener_arns = listener_arn if isinstance(listener_arn, list) else [listener_arn]
+        with _metrics.phase('SnapshotFetchMs'):
+            snapshots = get_listener_snapshots(client, listener_arns)
+    _metrics.set('RuleCount', max(len(snapshot.priorities) for snapshot in snapshots))
 
-    while service_priority_final != service_priority_preliminary:
-        service_priority_preliminary = get_next_avail_priority(listener_arn)
-        time.sleep(5)
-        service_priority_final = get_next_avail_priority(listener_arn)
-
-    # Return the final service priority
-    service_priority = service_priority_final
+    # Existing services keep their priority, new services get a reserved one
+    # The reservation is a conditional write, so stacks deploying at the same time never get the same priority
+    store = get_reservation_store()
+    # Reservations other containers cannot see would let two stacks deploying at the same time get the same priority
+    if not store.shared and any(get_service_priority(service_name, snapshot, path) == -1 for _, service_name, path in services for snapshot in snapshots):
+        return send_response(event, context, "FAILED", {"Message": "RESERVATION_TABLE is not set, new rule priorities cannot be reserved"})
+    with _metrics.phase('AllocationMs'):
+        service_priorities = allocate_service_priorities(snapshots, services, store, strategy, band)
 
     # Limit of 50000
     # see https://docs.aws.amazon.com/elasticloadbalancing/latest/APIReference/API_CreateRule.html
-    if service_priority > 50000:
+    if any(priority > MAX_RULE_PRIORITY for priority in service_priorities.values()):
+        if band != (1, MAX_RULE_PRIORITY):
+            return send_response(event, context, "FAILED", {"Message": "No free rule priority left in priority_band " + str(band[0]) + "-" + str(band[1])})
         return send_response(event, context, "FAILED", {"Message": "Load balancer has reached its rule priority limit, provision a different load balancer"})
 
-    return send_response(event, context, "SUCCESS", ({ 'priority': '' + str(service_priority) +'' }))
+    listener_index = 0
+    if 'listener_pool' in resource_properties:
+        listener_index = resource_properties['listener_pool'].index(snapshots[0].listener_arn)
 
-#### Returns next available priority to use for a listener ####
-def get_next_avail_priority(listener_arn):
-    
-    client = boto3.client('elbv2')
-    rules = client.describe_rules(
-        ListenerArn=listener_arn,
-    )['Rules']
-
-    rules = [rule for rule in rules if rule['Priority'].isdigit()]
-
-    # No rules are in use, return 1
-    if not rules:
-        return 1
-
-    sorted_rules = sorted(rules, key=lambda x: int(x['Priority']), reverse=False)
-    # Transform to flat structure
-    number_sequence = []
-    for rule in sorted_rules:
-        number_sequence.append(int(rule['Priority']))
-    
-    # Test cases
-    #number_sequence = [1, 2, 3, 4, 5, 6, 7, 101, 102, 203, 206, 207, 208, 209, 210, 212, 301, 302]
-    #number_sequence = [101, 102]
-    print(number_sequence)
-    
-    # 1 is not used yet, so use 1
-    if 1 not in number_sequence:
-        return 1
-        
-    diff_between_elements = [j-i for i, j in zip(number_sequence[:-1], number_sequence[1:])]
-    for diff in diff_between_elements:
-        number_sequence.append(int(rule['Priority']))  
-    #print(diff_between_elements)
-    index = 0
-    if len(diff_between_elements) == 0:
-        return 2 # Only 1 rule so the next rule priority is 2
-    for x in diff_between_elements:
-        if x != 1:
-            break
+    physical_resource_id = encode_physical_resource_id(resource_properties, listener_index, list(service_priorities.values()))
+    return send_response(event, context, "SUCCESS", build_response_data(resource_properties, service_priorities, listener_index), physical_resource_id)
+
+#### Returns the Data of a successful response ####
+def build_response_data(resource_properties, service_priorities, listener_index):
+    if 'service_names' not in resource_properties:
+        response_data = { 'priority': '' + str(list(service_priorities.values())[0]) +'' }
+    else:
+        # One attribute per service for !GetAtt
+        response_data = { name: str(priority) for name, priority in service_priorities.items() }
+
+    if 'listener_pool' in resource_properties:
+        response_data['listener_arn'] = resource_properties['listener_pool'][listener_index]
+
+    return response_data
+
+#### Returns a PhysicalResourceId holding the outcome of a request ####
+def encode_physical_resource_id(resource_properties, listener_index, priorities):
+    """
+    listener-rule-priority:<digest of the properties>:<index into listener_pool>:<priorities in service order>
+    The listeners and services themselves are in the properties CloudFormation sends with every request.
+    """
+    return ':'.join([
+        PHYSICAL_RESOURCE_ID_PREFIX,
+        get_properties_digest(resource_properties),
+        str(listener_index),
+        ','.join(str(priority) for priority in priorities)
+    ])
+
+#### Returns (digest, listener_index, priorities) of a PhysicalResourceId, or None if this Lambda did not make it ####
+def decode_physical_resource_id(physical_resource_id):
+    parts = (physical_resource_id or '').split(':')
+    if len(parts) != 4 or parts[0] != PHYSICAL_RESOURCE_ID_PREFIX:
+        return None
+    try:
+        return parts[1], int(parts[2]), [int(priority) for priority in parts[3].split(',')]
+    except ValueError:
+        return None
+
+#### Returns a digest of the resource properties, ignoring the ServiceToken ####
+def get_properties_digest(resource_properties):
+    properties = { key: value for key, value in resource_properties.items() if key != 'ServiceToken' }
+    return hashlib.sha256(json.dumps(properties, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+#### Returns the listeners, service priorities and listener index held in the PhysicalResourceId of a request, or None ####
+def get_recorded_allocation(event):
+    decoded = decode_physical_resource_id(event.get('PhysicalResourceId'))
+    if decoded is None:
+        return None
+    digest, listener_index, priorities = decoded
+    resource_properties = event['ResourceProperties']
+    if digest != get_properties_digest(resource_properties):
+        return None
+    try:
+        services = get_requested_services(resource_properties)
+    except ValueError:
+        return None
+
+    names = [name for name, _, _ in services]
+    if len(names) != len(priorities):
+        return None
+
+    if 'listener_pool' in resource_properties:
+        listener_arns = [resource_properties['listener_pool'][listener_index]]
+    else:
+        listener_arn = resource_properties['listener_arn']
+        listener_arns = listener_arn if isinstance(listener_arn, list) else [listener_arn]
+    return listener_arns, services, dict(zip(names, priorities)), listener_index
+
+#### Returns the Data of an Update which does not change any property, without reading the listeners ####
+def get_unchanged_update_data(event):
+    old_properties = { key: value for key, value in event.get('OldResourceProperties', {}).items() if key != 'ServiceToken' }
+    new_properties = { key: value for key, value in event['ResourceProperties'].items() if key != 'ServiceToken' }
+    if old_properties != new_properties:
+        return None
+    recorded = get_recorded_allocation(event)
+    if recorded is None:
+        return None
+    listener_arns, services, service_priorities, listener_index = recorded
+    return build_response_data(event['ResourceProperties'], service_priorities, listener_index)
+
+#### Releases the reservations held for a deleted resource ####
+def release_reservations(event):
+    # Without RESERVATION_TABLE a Create never reserves (new services fail), so there is no store to build
+    if _reservation_store is None and not RESERVATION_TABLE:
+        return
+    try:
+        recorded = get_recorded_allocation(event)
+        if recorded is None:
+            return
+        listener_arns, services, service_priorities, listener_index = recorded
+        store = get_reservation_store()
+        for name, service_name, path in services:
+            reservation_name = service_name if not path else service_name + path
+            for listener_arn in listener_arns:
+                store.release(listener_arn, service_priorities[name], reservation_name)
+    except Exception as err:
+        # Never fail a delete over a reservation, it expires on its own
+        print("Unable to release reservations: " + str(err))
+
+#### Returns the requested services as a list of (name, service_name, path) ####
+def get_requested_services(resource_properties):
+    """
+    service_names takes a list of host names, or of objects with a service_name, an optional path
+    and an optional name for the returned attribute (defaults to the service_name)
+    """
+    if 'service_names' not in resource_properties:
+        service_name = resource_properties['service_name']
+        return [(service_name, service_name, None)]
+
+    service_names = resource_properties['service_names']
+    # A string would be taken one character at a time
+    if not isinstance(service_names, list) or not service_names:
+        raise ValueError("service_names must be a non-empty list of service names")
+
+    services = []
+    for item in service_names:
+        if isinstance(item, dict):
+            if 'service_name' not in item:
+                raise ValueError("Missing service_name in " + json.dumps(item))
+            services.append((item.get('name', item['service_name']), item['service_name'], item.get('path')))
+        elif isinstance(item, str):
+            services.append((item, item, None))
         else:
-            index = index + 1
-    
-    priority = int(number_sequence[index])+1
-
-    return priority    
-
-#### Returns rule priority of a service name in the host header property ####
-def get_service_priority(service_name, listener_arn):
-    client = boto3.client('elbv2')
-    # Service name
-    rules = client.describe_rules(
-        ListenerArn=listener_arn,
-    )['Rules']
-    for rule in rules:
-        #print(rule)
-        if (len(rule['Conditions']) > 0):
-            conditions = (rule['Conditions'])[0]
-            host_header = (conditions['Values'])[0]
-            if host_header == service_name:
-                # print(rule['Priority'] + " " + (conditions['Values'])[0])
-                return int(rule['Priority'])
-    
-    return -1
+            raise ValueError("Invalid service in service_names " + json.dumps(item) + ", expected a host name or an object with a service_name")
+
+    # Each name is an attribute of the resource, a service with another path needs a name of its own
+    names = [name for name, _, _ in services]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError("Duplicate names in service_names " + ", ".join(duplicates) + ", give each service with a path its own name")
+    return services
+
+#### Returns the listener of a pool to add the services to, or None if every load balancer is at its rule quota ####
+def choose_pool_listener(snapshots, services, sticky, rule_quota):
+    # Services which already exist stay on their listener
+    if sticky:
+        for snapshot in snapshots:
+            if any(get_service_priority(service_name, snapshot, path) != -1 for _, service_name, path in services):
+                return snapshot
+
+    # The quota is per load balancer, so the rules of its listeners in the pool are added up
+    load_balancer_rules = {}
+    for snapshot in snapshots:
+        load_balancer_id = get_load_balancer_id(snapshot.listener_arn)
+        load_balancer_rules[load_balancer_id] = load_balancer_rules.get(load_balancer_id, 0) + snapshot.rule_count()
+    rule_count = lambda snapshot: load_balancer_rules[get_load_balancer_id(snapshot.listener_arn)]
+
+    # Otherwise the listener of the least loaded load balancer with room for all the services
+    candidates = [snapshot for snapshot in snapshots if rule_count(snapshot) + len(services) <= rule_quota]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda snapshot: (rule_count(snapshot), snapshot.rule_count()))
+
+#### Returns the load balancer (app/<name>/<id>) of a listener ARN ####
+def get_load_balancer_id(listener_arn):
+    return listener_arn.split(':listener/', 1)[-1].rsplit('/', 1)[0]
+
+#### Returns the snapshots of the listeners, read concurrently when there is more than one ####
+def get_listener_snapshots(client, listener_arns):
+    if len(listener_arns) == 1:
+        return [_listener_cache.get(client, listener_arns[0])]
+
+    # Reads run side by side, so this takes as long as the slowest listener rather than the sum of them
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(listener_arns), LISTENER_FETCH_WORKERS)) as executor:
+        return list(executor.map(lambda listener_arn: _listener_cache.get(client, listener_arn), listener_arns))
+
+#### Returns whether existing services stay on their listener (sticky) and the rule quota of a listener_pool request ####
+def get_pool_options(resource_properties):
+    listener_pool = resource_properties['listener_pool']
+    # A string would be taken one character at a time
+    if not isinstance(listener_pool, list) or not listener_pool:
+        raise ValueError("listener_pool must be a non-empty list of listener ARNs")
+
+    sticky = str(resource_properties.get('sticky', 'true')).lower()
+    if sticky not in ('true', 'false'):
+        raise ValueError("Invalid sticky " + json.dumps(resource_properties['sticky']) + ", use true or false")
+
+    # CloudFormation passes numbers as strings
+    rule_quota = resource_properties.get('rule_quota', LISTENER_RULE_QUOTA)
+    try:
+        rule_quota = int(rule_quota)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid rule_quota " + json.dumps(rule_quota) + ", expected a number of rules")
+    if rule_quota < 1:
+        raise ValueError("Invalid rule_quota " + json.dumps(resource_properties['rule_quota']) + ", it must be at least 1")
+    return sticky == 'true', rule_quota
+
+#### Returns the allocation strategy and priority band (first, last) of a request ####
+def get_allocation_options(resource_properties):
+    strategy = resource_properties.get('allocation_strategy', 'lowest')
+    if strategy not in ALLOCATION_STRATEGIES:
+        raise ValueError("Unknown allocation_strategy " + str(strategy) + ", use one of " + ", ".join(ALLOCATION_STRATEGIES))
+
+    band = resource_properties.get('priority_band')
+    if band is None:
+        return strategy, (1, MAX_RULE_PRIORITY)
+    # CloudFormation passes numbers as strings, take "1000-1999" or ["1000", "1999"]
+    bounds = band.split('-') if isinstance(band, str) else band
+    try:
+        start, end = [int(bound) for bound in bounds]
+    except (TypeError, ValueError):
+        raise ValueError("Invalid priority_band " + json.dumps(band) + ", expected first-last e.g. 1000-1999")
+    if not 1 <= start <= end <= MAX_RULE_PRIORITY:
+        raise ValueError("Invalid priority_band " + json.dumps(band) + ", it must be inside 1-" + str(MAX_RULE_PRIORITY))
+    return strategy, (start, end)
+
+#### Returns the priority of every requested service, the same on every listener, re-using existing priorities and reserving new ones ####
+def allocate_service_priorities(snapshots, services, store, strategy='lowest', band=(1, MAX_RULE_PRIORITY)):
+    if LOG_LEVEL == 'DEBUG':
+        for snapshot in snapshots:
+            print(snapshot.listener_arn + " " + str(snapshot.priorities))
+
+    # Priorities free on every listener
+    index = FreePriorityIndex.intersect([snapshot.free_index() for snapshot in snapshots])
+
+    priorities = {}
+    for name, service_name, path in services:
+        reservation_name = service_name if not path else service_name + path
+
+        # Service already exists, re-use the same priority
+        service_priority = get_existing_priority(snapshots, service_name, path, reservation_name, store)
+        if service_priority != -1:
+            print("Found existing service " + service_name + ", returning " + str(service_priority))
+        else:
+            service_priority = allocate_priority(snapshots, index, reservation_name, store, strategy, band)
+            print("Returning rule priority " + str(service_priority) + " for service " + service_name)
+
+        index.reserve(service_priority)
+        for snapshot in snapshots:
+            snapshot.record_allocation(service_priority, service_name, path)
+        priorities[name] = service_priority
+    return priorities
+
+#### Returns the priority a service already has, as long as it can be the same on every listener ####
+def get_existing_priority(snapshots, service_name, path, reservation_name, store):
+    listener_priorities = [get_service_priority(service_name, snapshot, path) for snapshot in snapshots]
+    found = [priority for priority in listener_priorities if priority != -1]
+    if not found:
+        return -1
+    priority = min(found)
+
+    # Listeners without the service at this priority need it free, and reserved for the service
+    missing = [snapshot for snapshot, listener_priority in zip(snapshots, listener_priorities) if listener_priority != priority]
+    if any(not snapshot.free_index().is_free(priority) for snapshot in missing):
+        print("Priority " + str(priority) + " of service " + service_name + " is taken on another listener, allocating a new one")
+        return -1
+    if not reserve_on_listeners(store, [snapshot.listener_arn for snapshot in missing], priority, reservation_name):
+        return -1
+    return priority
+
+#### Reserves and returns a priority free on every listener for a new service ####
+def allocate_priority(snapshots, index, service_name, store, strategy='lowest', band=(1, MAX_RULE_PRIORITY)):
+    listener_arns = [snapshot.listener_arn for snapshot in snapshots]
+    start, end = band
+    if strategy == 'hash':
+        preferred = get_hashed_priority(service_name, start, end)
+    else:
+        preferred = start
+
+    priority = find_free_priority(index, preferred, start, end)
+    while priority != -1:
+        # Whether we get it or another service already holds it, this priority is no longer free
+        index.reserve(priority)
+        _metrics.add('AllocationAttempts')
+        if reserve_on_listeners(store, listener_arns, priority, service_name):
+            return priority
+        priority = find_free_priority(index, priority, start, end)
+
+    # Every priority is in use or reserved, anything above the limit is rejected by the handler
+    return MAX_RULE_PRIORITY + 1
+
+#### Returns the first free priority probing forward from preferred, wrapping around inside the band ####
+def find_free_priority(index, preferred, start, end):
+    priority = index.first_free(preferred, end)
+    if priority == -1:
+        priority = index.first_free(start, preferred - 1)
+    return priority
+
+#### Returns the preferred priority of a service inside the band, stable across invocations ####
+def get_hashed_priority(service_name, start, end):
+    # Not hash(), which is salted per process
+    digest = hashlib.sha256(service_name.encode('utf-8')).digest()
+    return start + int.from_bytes(digest[:8], 'big') % (end - start + 1)
+
+#### Reserves the priority for the service on every listener, or on none of them ####
+def reserve_on_listeners(store, listener_arns, priority, service_name):
+    reserved = []
+    for listener_arn in listener_arns:
+        if not store.reserve(listener_arn, priority, service_name, RESERVATION_TTL_SECONDS):
+            for reserved_arn in reserved:
+                store.release(reserved_arn, priority, service_name)
+            return False
+        reserved.append(listener_arn)
+    return True
+
+#### Returns rule priority of a service name (and optional path) in the host header and path pattern conditions ####
+def get_service_priority(service_name, snapshot, path=None):
+    match = snapshot.condition_index().lookup(service_name, path)
+    if match is None:
+        # Handed out by this Lambda since the rules were read
+        return snapshot.allocations.get((service_name, path or None), -1)
+    return match[1]
+
+#### Sends responses back to CloudFormation ####
+class ResponseSender:
+    """
+    PUTs custom resource responses to the pre-signed ResponseURL over a connection pool kept for the life
+    of the container. Every attempt is bounded by connect and read timeouts, connection errors and 5xx
+    responses are retried after an exponential backoff with full jitter, and the latency of each attempt
+    of the last send is kept in attempts.
+    """
+
+    def __init__(self, connect_timeout, read_timeout, max_attempts, base_delay=0.2, max_delay=2.0):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempts = []
+        self._urllib3 = None
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            import urllib3
+            self._urllib3 = urllib3
+            self._pool = urllib3.PoolManager(
+                num_pools=2,
+                maxsize=1,
+                timeout=urllib3.Timeout(connect=self.connect_timeout, read=self.read_timeout),
+                retries=False
+            )
+        return self._pool
+
+    def send(self, url, body):
+        """
+        Returns the status code of the last attempt, or -1 if no attempt got a response
+        """
+        pool = self._get_pool()
+        self.attempts = []
+        for attempt in range(1, self.max_attempts + 1):
+            started = time.perf_counter()
+            # A failed attempt does not report the status of the one before it
+            status = -1
+            error = None
+            try:
+                response = pool.request('PUT', url, body=body, headers={ 'Content-Type': '', 'Content-Length': str(len(body)) })
+                status = response.status
+            except self._urllib3.exceptions.HTTPError as err:
+                error = err
+            latency = time.perf_counter() - started
+            self.attempts.append({ 'attempt': attempt, 'status': status, 'latency_ms': round(latency * 1000, 1), 'error': str(error) if error else None })
+            print("Response attempt " + str(attempt) + ": status " + str(status) + " in " + format_ms(latency) + (", " + str(error) if error else ""))
+
+            if error is None and status < 500:
+                break
+            if attempt < self.max_attempts:
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))))
+        return status
+
+_response_sender = ResponseSender(RESPONSE_CONNECT_TIMEOUT_SECONDS, RESPONSE_READ_TIMEOUT_SECONDS, RESPONSE_MAX_ATTEMPTS)
 
 #### Send response function ####
-def send_response(event, context, response_status, response_data):
+def send_response(event, context, response_status, response_data, physical_resource_id=None):
     # Send a resource manipulation status response back to CloudFormation
     # Sample response
     # {
     #     "Status": "SUCCESS",
     #     "Reason": "See the details in CloudWatch Log Stream: 2019/03/04/[$LATEST]Fake-ResourceId",
-    #     "PhysicalResourceId": "2019/03/04/[$LATEST]Fake-ResourceId",
+    #     "PhysicalResourceId": "listener-rule-priority:5b2c0e6b4f1d9a37:0:8",
     #     "StackId": "arn:aws:cloudformation:eu-west-1:FakeAccount123:stack/LambdaFunction/SomeId",
     #     "RequestId": "fake-requestId",
     #     "LogicalResourceId": "LambdaFunction",
@@ -161,17 +980,32 @@ def send_response(event, context, response_status, response_data):
     # }
     # Format of this request is defined at https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/crpg-ref-responses.html
 
+    # Keep the PhysicalResourceId of an existing resource unless told otherwise, changing it replaces the resource
+    if physical_resource_id is None:
+        physical_resource_id = event.get('PhysicalResourceId', context.log_stream_name)
+
     response_body = json.dumps({
         "Status": response_status,
         "Reason": "See the details in CloudWatch Log Stream: " + context.log_stream_name,
-        "PhysicalResourceId": context.log_stream_name,
+        "PhysicalResourceId": physical_resource_id,
         "StackId": event['StackId'],
         "RequestId": event['RequestId'],
         "LogicalResourceId": event['LogicalResourceId'],
         "Data": response_data
     })
 
+    # A response CloudFormation would reject leaves the stack waiting for the custom resource to time out
+    if len(response_body.encode('utf-8')) > MAX_RESPONSE_BYTES and response_status == "SUCCESS":
+        message = "Response of " + str(len(response_body.encode('utf-8'))) + " bytes is over the " + str(MAX_RESPONSE_BYTES) + " bytes CloudFormation accepts, split service_names across several custom resources"
+        return send_response(event, context, "FAILED", {"Message": message}, physical_resource_id)
+
     print("ResponseURL: " + str(event['ResponseURL']))
     print("ResponseBody: " + response_body)
-    req = requests.put(event['ResponseURL'], data=response_body)
-    print("Status code: " + str(req.status_code))
+    with _metrics.phase('ResponseSendMs'):
+        status_code = _response_sender.send(event['ResponseURL'], response_body.encode('utf-8'))
+    print("Status code: " + str(status_code))
+    _metrics.set('Status', response_status)
+    _metrics.add('ResponseAttempts', len(_response_sender.attempts))
+
+# Cold start timing, logged once per container
+print("Init: module loaded in " + format_ms(time.perf_counter() - _init_started))
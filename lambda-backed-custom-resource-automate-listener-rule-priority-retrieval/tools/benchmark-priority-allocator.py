@@ -0,0 +1,237 @@
+"""
+Benchmarks both listener rule priority Lambda modules offline, against FakeElbv2 listeners of 10 to 50000 rules
+in dense, fragmented and adversarial priority layouts. Every invocation starts cold (empty listener cache and
+reservation store) and its response is captured instead of sent, so nothing sleeps or touches the network.
+Prints the results as JSON, and with --baseline exits 1 when they regress against an earlier run.
+
+    $ python benchmark-priority-allocator.py [--sizes 10,1000,50000] [--output results.json] [--baseline baseline.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from fake_elbv2 import FakeElbv2
+from priority_lambda import HANDLER_MODULES, CapturingSender, LambdaContext, load_handler_module, make_event
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-infra-ecs-dev/1234/5678'
+
+LAYOUTS = ('dense', 'fragmented', 'adversarial')
+
+SCENARIOS = ('create', 'create-hash', 'existing', 'update-unchanged', 'api-new', 'api-existing', 'api-map')
+
+# Scenarios driving the API Gateway lambda_handler, only the code-only module has it
+API_SCENARIOS = ('api-new', 'api-existing', 'api-map')
+
+def make_rules(layout, size, seed=0):
+    """
+    Given a layout and a number of rules, returns the (priority, host, path) tuples of the listener
+
+    dense: priorities 1..size, the first free priority is right after the last rule
+    fragmented: size priorities scattered over the lower part of the range, leaving many small gaps
+    adversarial: priorities packed at the top of the range and every rule on the same host with its own path,
+                 so hashed priorities probe to the end of the range and wrap around, and one host carries every rule
+
+    Args:
+        (str) layout: one of LAYOUTS
+        (int) size: number of rules
+        (int) seed: seed of the fragmented layout
+
+    Returns:
+        (list) rules: (priority, host, path) tuples
+    """
+    max_priority = 50000
+    if layout == 'dense':
+        priorities = range(1, size + 1)
+    elif layout == 'fragmented':
+        priorities = sorted(random.Random(seed).sample(range(1, min(max_priority, size * 4) + 1), size))
+    elif layout == 'adversarial':
+        return [(priority, 'lcg-shared.lcg.com', '/svc' + str(priority) + '/*') for priority in range(max_priority - size + 1, max_priority + 1)]
+    else:
+        raise ValueError("Unknown layout " + layout)
+    return [(priority, 'lcg-svc' + str(priority) + '.lcg.com', None) for priority in priorities]
+
+def make_fake(layout, size):
+    """
+    Returns a FakeElbv2 holding one listener with the layout's rules, and the host and path of a rule on it
+    """
+    rules = make_rules(layout, size)
+    fake = FakeElbv2()
+    fake.add_listener(LISTENER_ARN, rules)
+    _, host, path = rules[len(rules) // 2]
+    return fake, host, path
+
+def reset_module(module, fake, sender):
+    """
+    Makes the next invocation a cold one: no cached listeners, no reservations and a fresh call count
+    """
+    module._clients['elbv2'] = fake
+    module._listener_cache = module.ListenerCache(module.LISTENER_CACHE_MAX_ENTRIES, module.LISTENER_CACHE_TTL_SECONDS)
+    module._reservation_store = module.InMemoryReservationStore()
+    module._response_sender = sender
+    fake.calls = {}
+
+def make_invocation(module, scenario, fake, host, path, sender):
+    """
+    Returns a function running one invocation of the scenario
+    """
+    new_service = 'lcg-benchmark.lcg.com'
+    if scenario == 'api-new':
+        event = { 'listener_arn': LISTENER_ARN, 'service_name': new_service }
+        return lambda: module.lambda_handler(event, LambdaContext())
+    if scenario == 'api-existing':
+        event = { 'listener_arn': LISTENER_ARN, 'service_name': host }
+        return lambda: module.lambda_handler(event, LambdaContext())
+    if scenario == 'api-map':
+        event = { 'listener_arn': LISTENER_ARN }
+        return lambda: module.lambda_handler(event, LambdaContext())
+
+    if scenario == 'create':
+        properties = { 'listener_arn': LISTENER_ARN, 'service_name': new_service }
+    elif scenario == 'create-hash':
+        properties = { 'listener_arn': LISTENER_ARN, 'service_name': new_service, 'allocation_strategy': 'hash' }
+    elif scenario == 'existing':
+        properties = { 'listener_arn': LISTENER_ARN, 'service_names': [{ 'name': 'priority', 'service_name': host, 'path': path }] }
+    elif scenario == 'update-unchanged':
+        properties = { 'listener_arn': LISTENER_ARN, 'service_name': new_service }
+        # The PhysicalResourceId handed back by the Create this Update follows
+        reset_module(module, fake, sender)
+        with contextlib.redirect_stdout(io.StringIO()):
+            module.handler(make_event('Create', properties), LambdaContext())
+        event = make_event('Update', properties, sender.body['PhysicalResourceId'])
+        return lambda: module.handler(event, LambdaContext())
+    else:
+        raise ValueError("Unknown scenario " + scenario)
+    event = make_event('Create', properties)
+    return lambda: module.handler(event, LambdaContext())
+
+def run_case(module, scenario, layout, size, repeat):
+    """
+    Runs the scenario repeat times and returns its latency, elbv2 calls, peak memory and outcome
+    """
+    fake, host, path = make_fake(layout, size)
+    sender = CapturingSender()
+    invoke = make_invocation(module, scenario, fake, host, path, sender)
+
+    latencies = []
+    for _ in range(repeat):
+        reset_module(module, fake, sender)
+        # The handlers print what they do, which is part of their cost but not of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            result = invoke()
+            latencies.append(time.perf_counter() - started)
+    calls = dict(fake.calls)
+
+    # One more run for memory, tracemalloc slows everything down so it is kept out of the timings
+    reset_module(module, fake, sender)
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        invoke()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    if scenario in API_SCENARIOS:
+        outcome = result['statusCode']
+        priority = json.loads(result['body']).get('priority')
+    else:
+        outcome = sender.body['Status']
+        priority = sender.body['Data'].get('priority')
+
+    return {
+        'latency_ms': {
+            'min': round(min(latencies) * 1000, 3),
+            'median': round(statistics.median(latencies) * 1000, 3),
+            'max': round(max(latencies) * 1000, 3)
+        },
+        'elbv2_calls': calls,
+        'peak_memory_kb': round(peak / 1024.0, 1),
+        'outcome': outcome,
+        'priority': priority
+    }
+
+def run_benchmark(module_names, scenarios, layouts, sizes, repeat):
+    """
+    Returns the results of every combination, keyed module/scenario/layout/size
+    """
+    results = {}
+    for module_name in module_names:
+        with contextlib.redirect_stdout(io.StringIO()):
+            module = load_handler_module(module_name)
+        for scenario in scenarios:
+            if scenario in API_SCENARIOS and not hasattr(module, 'lambda_handler'):
+                continue
+            for layout in layouts:
+                for size in sizes:
+                    key = '/'.join([module_name, scenario, layout, str(size)])
+                    results[key] = run_case(module, scenario, layout, size, repeat)
+                    print(key + ": " + str(results[key]['latency_ms']['median']) + " ms", file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Given the results and those of an earlier run, returns the regressions: a median latency more than
+    tolerance (a fraction) above the baseline, or any elbv2 call count above it
+
+    Returns:
+        (list) regressions: one message per regression
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        median, median_before = result['latency_ms']['median'], before['latency_ms']['median']
+        if median > median_before * (1 + tolerance):
+            regressions.append(key + ": median latency " + str(median_before) + " ms -> " + str(median) + " ms")
+        for operation, count in sorted(result['elbv2_calls'].items()):
+            count_before = before['elbv2_calls'].get(operation, 0)
+            if count > count_before:
+                regressions.append(key + ": " + operation + " calls " + str(count_before) + " -> " + str(count))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the listener rule priority Lambda against in-memory listeners")
+    parser.add_argument('--modules', default=','.join(sorted(HANDLER_MODULES)), help="handler modules to run, comma separated")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="scenarios to run, comma separated")
+    parser.add_argument('--layouts', default=','.join(LAYOUTS), help="priority layouts, comma separated")
+    parser.add_argument('--sizes', default='10,100,1000,10000,50000', help="rules per listener, comma separated")
+    parser.add_argument('--repeat', type=int, default=5, help="timed invocations per combination")
+    parser.add_argument('--output', help="file to write the JSON results to, instead of stdout")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="allowed median latency increase over the baseline, as a fraction")
+    args = parser.parse_args()
+
+    # Reservations stay in memory, never in a real table
+    os.environ.pop('RESERVATION_TABLE', None)
+
+    results = run_benchmark(
+        args.modules.split(','),
+        args.scenarios.split(','),
+        args.layouts.split(','),
+        [int(size) for size in args.sizes.split(',')],
+        args.repeat
+    )
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
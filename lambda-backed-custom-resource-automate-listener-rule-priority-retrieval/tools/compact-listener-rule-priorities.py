@@ -0,0 +1,103 @@
+"""
+Renumbers the rules of a listener to close the gaps left by years of creating and deleting services,
+keeping the rules in the same order. Prints the plan (a dry run) unless --apply is given.
+
+    $ python compact-listener-rule-priorities.py --listener-arn arn:aws:elasticloadbalancing:... [--apply]
+"""
+import argparse
+
+from priority_lambda import load_handler_module
+
+lambda_module = load_handler_module()
+
+def plan_compaction(snapshot, start=1, step=1):
+    """
+    Given a listener snapshot, returns the moves which renumber its rules start, start + step, ...
+    in their current order, ordered so no move ever lands on a priority still in use
+
+    Args:
+        (ListenerRuleSnapshot) snapshot: the listener rules
+        (int) start: priority of the first rule
+        (int) step: gap between consecutive priorities
+
+    Returns:
+        (list) moves: (rule_arn, old priority, new priority) for every rule whose priority changes
+    """
+    rules = sorted(
+        [rule for rule in snapshot.rules if rule['Priority'].isdigit()],
+        key=lambda rule: int(rule['Priority'])
+    )
+    last = start + (len(rules) - 1) * step
+    if rules and last > lambda_module.MAX_RULE_PRIORITY:
+        raise ValueError("Renumbering " + str(len(rules)) + " rules from " + str(start) + " in steps of " + str(step) + " goes past " + str(lambda_module.MAX_RULE_PRIORITY))
+
+    down = []
+    up = []
+    for i, rule in enumerate(rules):
+        old = int(rule['Priority'])
+        new = start + i * step
+        if new < old:
+            down.append((rule['RuleArn'], old, new))
+        elif new > old:
+            up.append((rule['RuleArn'], old, new))
+
+    # As the order is kept, rules moving down only land on priorities vacated by lower rules moving down
+    # before them, and rules moving up only on priorities vacated by higher rules moving up before them
+    return down + list(reversed(up))
+
+def batch_moves(moves, batch_size):
+    """
+    Given the planned moves, returns them in batches of batch_size for set_rule_priorities
+    """
+    return [moves[i:i + batch_size] for i in range(0, len(moves), batch_size)]
+
+def print_plan(listener_arn, snapshot, moves, batches):
+    """
+    Prints the plan as a diff of rule priorities
+    """
+    print("Listener " + listener_arn)
+    print(str(len(snapshot.priorities)) + " rules, " + str(len(moves)) + " to move in " + str(len(batches)) + " set_rule_priorities call(s)")
+    for rule_arn, old, new in moves:
+        print("  " + rule_arn.split('/')[-1] + ": " + str(old) + " -> " + str(new))
+
+def apply_plan(client, batches):
+    """
+    Applies the batches of moves in order with set_rule_priorities
+    """
+    for i, batch in enumerate(batches):
+        client.set_rule_priorities(
+            RulePriorities=[{ 'RuleArn': rule_arn, 'Priority': new } for rule_arn, old, new in batch]
+        )
+        print("Applied batch " + str(i + 1) + " of " + str(len(batches)))
+
+def compact_listener(client, listener_arn, start=1, step=1, batch_size=100, apply=False):
+    """
+    Given an elbv2 client (real or a stand-in) and a listener, plans the compaction, prints it and applies it if asked
+
+    Returns:
+        (list) moves: the planned moves
+    """
+    snapshot = lambda_module.ListenerRuleSnapshot.fetch(client, listener_arn)
+    moves = plan_compaction(snapshot, start, step)
+    batches = batch_moves(moves, batch_size)
+    print_plan(listener_arn, snapshot, moves, batches)
+    if apply and moves:
+        apply_plan(client, batches)
+    elif moves:
+        print("Dry run, run again with --apply to apply")
+    return moves
+
+def main():
+    parser = argparse.ArgumentParser(description="Renumbers the rules of a listener, keeping their order")
+    parser.add_argument('--listener-arn', required=True)
+    parser.add_argument('--start', type=int, default=1, help="priority of the first rule")
+    parser.add_argument('--step', type=int, default=1, help="gap between consecutive priorities")
+    parser.add_argument('--batch-size', type=int, default=100, help="rules moved per set_rule_priorities call")
+    parser.add_argument('--apply', action='store_true', help="apply the plan, otherwise only print it")
+    args = parser.parse_args()
+
+    import boto3
+    compact_listener(boto3.client('elbv2'), args.listener_arn, args.start, args.step, args.batch_size, args.apply)
+
+if __name__ == "__main__":
+    main()
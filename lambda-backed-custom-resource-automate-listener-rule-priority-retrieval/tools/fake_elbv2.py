@@ -0,0 +1,133 @@
+"""
+In-memory stand-in for the elbv2 client calls used by the listener rule priority Lambda and its tools.
+"""
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+class FakeElbv2:
+    """
+    Keeps the rules of any number of listeners in memory and answers describe_rules, create_rule,
+    delete_rule and set_rule_priorities like elbv2 does, including paging and priority conflicts.
+    Every call is counted in calls, and can be slowed down by latency seconds to mimic the real API.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._listeners = {}
+        # Priorities in use and the sorted describe_rules listing of each listener, so listeners with
+        # tens of thousands of rules are built and paged through in linear time
+        self._used = {}
+        self._described = {}
+        self._next_rule_id = 0
+
+    def add_listener(self, listener_arn, rules=()):
+        """
+        Given a listener ARN and (priority, host, path) tuples, adds the listener with those rules and a default rule
+        """
+        with self._lock:
+            self._listeners[listener_arn] = {}
+            self._used[listener_arn] = set()
+            self._described.pop(listener_arn, None)
+        for priority, host, path in rules:
+            self._add_rule(listener_arn, priority, host, path)
+
+    def priorities(self, listener_arn):
+        """
+        Returns the priorities in use on the listener, in rule order
+        """
+        with self._lock:
+            return sorted(rule['Priority'] for rule in self._listeners[listener_arn].values())
+
+    def _count(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _add_rule(self, listener_arn, priority, host, path=None):
+        conditions = [{ 'Field': 'host-header', 'Values': [host], 'HostHeaderConfig': { 'Values': [host] } }]
+        if path:
+            conditions.append({ 'Field': 'path-pattern', 'Values': [path], 'PathPatternConfig': { 'Values': [path] } })
+        with self._lock:
+            if priority in self._used[listener_arn]:
+                raise _error('PriorityInUse', 'Priority ' + str(priority) + ' is currently in use')
+            self._next_rule_id = self._next_rule_id + 1
+            rule_arn = listener_arn.replace(':listener/', ':listener-rule/') + '/rule-' + str(self._next_rule_id)
+            self._listeners[listener_arn][rule_arn] = { 'RuleArn': rule_arn, 'Priority': priority, 'Conditions': conditions }
+            self._used[listener_arn].add(priority)
+            self._described.pop(listener_arn, None)
+        return rule_arn
+
+    def describe_rules(self, ListenerArn, PageSize=None, Marker=None):
+        self._count('describe_rules')
+        with self._lock:
+            described = self._described.get(ListenerArn)
+            if described is None:
+                rules = sorted(self._listeners[ListenerArn].values(), key=lambda rule: rule['Priority'])
+                described = [_describe(rule) for rule in rules]
+                described.append({ 'RuleArn': ListenerArn + '/default', 'Priority': 'default', 'Conditions': [], 'IsDefault': True })
+                self._described[ListenerArn] = described
+
+        start = int(Marker or 0)
+        end = start + (PageSize or 20)
+        response = { 'Rules': described[start:end] }
+        if end < len(described):
+            response['NextMarker'] = str(end)
+        return response
+
+    def create_rule(self, ListenerArn, Priority, Conditions, Actions=None):
+        self._count('create_rule')
+        host = path = None
+        for condition in Conditions:
+            if condition['Field'] == 'host-header':
+                host = condition['Values'][0]
+            elif condition['Field'] == 'path-pattern':
+                path = condition['Values'][0]
+        rule_arn = self._add_rule(ListenerArn, int(Priority), host, path)
+        return { 'Rules': [{ 'RuleArn': rule_arn, 'Priority': str(Priority) }] }
+
+    def delete_rule(self, RuleArn):
+        self._count('delete_rule')
+        with self._lock:
+            for listener_arn, rules in self._listeners.items():
+                rule = rules.pop(RuleArn, None)
+                if rule is not None:
+                    self._used[listener_arn].discard(rule['Priority'])
+                    self._described.pop(listener_arn, None)
+        return {}
+
+    def set_rule_priorities(self, RulePriorities):
+        self._count('set_rule_priorities')
+        with self._lock:
+            # The whole call is applied or none of it, checked against the priorities after the call
+            listeners = {}
+            for item in RulePriorities:
+                for listener_arn, rules in self._listeners.items():
+                    if item['RuleArn'] in rules:
+                        listeners.setdefault(listener_arn, {})[item['RuleArn']] = item['Priority']
+            for listener_arn, moves in listeners.items():
+                after = { rule_arn: moves.get(rule_arn, rule['Priority']) for rule_arn, rule in self._listeners[listener_arn].items() }
+                if len(set(after.values())) != len(after):
+                    raise _error('PriorityInUse', 'A priority in the request is currently in use')
+            described = []
+            for listener_arn, moves in listeners.items():
+                for rule_arn, priority in moves.items():
+                    rule = self._listeners[listener_arn][rule_arn]
+                    rule['Priority'] = priority
+                    described.append(_describe(rule))
+                self._used[listener_arn] = set(rule['Priority'] for rule in self._listeners[listener_arn].values())
+                self._described.pop(listener_arn, None)
+        return { 'Rules': described }
+
+def _describe(rule):
+    described = dict(rule)
+    described['Priority'] = str(rule['Priority'])
+    described['IsDefault'] = False
+    return described
+
+def _error(code, message):
+    return ClientError({ 'Error': { 'Code': code, 'Message': message } }, 'elbv2')
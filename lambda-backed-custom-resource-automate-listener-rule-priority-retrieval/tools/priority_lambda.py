@@ -0,0 +1,77 @@
+"""
+Loads the listener rule priority Lambda modules, so tools can drive them outside of Lambda.
+The module files are named for their Lambda handlers rather than as python modules, hence the loader.
+"""
+import contextlib
+import importlib.util
+import io
+import json
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HANDLER_MODULES = {
+    'pipe-deploy': os.path.join(ROOT, 'lambda-listener-rule-priority-for-custom-resource-only-with-pipe-deploy', 'lambda', 'lambda-listener_rule_priority.py'),
+    'code-only': os.path.join(ROOT, 'lambda-listener-rule-priority-for-normal-lambda-and-custom-resource-code-only', 'lambda-priority_rule_handler.py'),
+}
+
+def load_handler_module(name='pipe-deploy'):
+    """
+    Given the name of a handler module, loads it as a new module object with its own caches and clients
+
+    Args:
+        (str) name: one of HANDLER_MODULES
+
+    Returns:
+        (module) module: the loaded handler module
+    """
+    spec = importlib.util.spec_from_file_location('priority_lambda_' + name.replace('-', '_'), HANDLER_MODULES[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def call_quietly(function, *args, **kwargs):
+    """
+    Calls function and returns its result, keeping what it prints out of the output, as the handlers log every step
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+class LambdaContext:
+    """
+    The parts of the Lambda context object the handlers use
+    """
+    log_stream_name = '2019/03/04/[$LATEST]tools'
+
+class CapturingSender:
+    """
+    Stands in for a module's ResponseSender (set it as module._response_sender), keeping the last
+    response body instead of PUTting it to CloudFormation, so nothing waits on the network or a retry
+    """
+
+    def __init__(self):
+        self.attempts = []
+        self.body = None
+
+    def send(self, url, body):
+        self.body = json.loads(body.decode('utf-8'))
+        self.attempts = [{ 'attempt': 1, 'status': 200, 'latency_ms': 0.0, 'error': None }]
+        return 200
+
+def make_event(request_type, properties, physical_resource_id=None):
+    """
+    Returns a custom resource event from CloudFormation, an Update with unchanged properties if given a physical_resource_id
+    """
+    event = {
+        'RequestType': request_type,
+        'ResponseURL': 'https://fakeurlToCloudformation',
+        'StackId': 'arn:aws:cloudformation:eu-west-1:FakeAccount123:stack/fake/SomeId',
+        'RequestId': 'fake-requestId',
+        'LogicalResourceId': 'FakeInfo',
+        'ResourceType': 'Custom::FakeInfo',
+        'ResourceProperties': properties
+    }
+    if physical_resource_id is not None:
+        event['PhysicalResourceId'] = physical_resource_id
+        event['OldResourceProperties'] = properties
+    return event
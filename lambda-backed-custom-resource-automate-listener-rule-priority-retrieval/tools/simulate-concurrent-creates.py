@@ -0,0 +1,213 @@
+"""
+Simulates stacks deploying side by side against one listener: each stack's custom resource Create runs in its own
+Lambda container (a separately loaded handler module) on a thread, then its listener rule is created on a FakeElbv2
+after a delay, as CloudFormation would. A rule whose priority was taken in the meantime is a collision.
+Prints, for every reservation store and allocation strategy, the collision rate, time-to-allocate percentiles
+and API calls as JSON.
+
+    $ python simulate-concurrent-creates.py [--stacks 50] [--concurrency 10] [--latency 0.05] [--rule-delay 0.5]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from fake_elbv2 import FakeElbv2
+from priority_lambda import CapturingSender, LambdaContext, load_handler_module, make_event
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-infra-ecs-dev/1234/5678'
+
+# shared: one store for every container, as with RESERVATION_TABLE set
+# per-container: each container only knows its own reservations, as without RESERVATION_TABLE, so new services fail
+STORES = ('shared', 'per-container')
+
+class CountingReservationStore:
+    """
+    Wraps a reservation store, counting its calls and slowing each one down by latency seconds
+    """
+
+    def __init__(self, store, latency=0.0):
+        self.store = store
+        self.shared = store.shared
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _count(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reserve(self, listener_arn, priority, service_name, ttl):
+        self._count('reserve')
+        return self.store.reserve(listener_arn, priority, service_name, ttl)
+
+    def release(self, listener_arn, priority, service_name):
+        self._count('release')
+        return self.store.release(listener_arn, priority, service_name)
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (nearest rank) of the values
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, int(round(p / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def deploy_stack(containers, fake, stack, strategy, rule_delay):
+    """
+    Runs one stack: the custom resource Create on a free container, then its listener rule after rule_delay
+
+    Returns:
+        (dict) outcome: the stack's priority, time to allocate and whether its rule collided
+    """
+    service_name = 'lcg-sim' + str(stack) + '.lcg.com'
+    properties = { 'listener_arn': LISTENER_ARN, 'service_name': service_name, 'allocation_strategy': strategy }
+
+    # A container handles one invocation at a time
+    module, sender = containers.get()
+    try:
+        started = time.perf_counter()
+        module.handler(make_event('Create', properties), LambdaContext())
+        allocate_seconds = time.perf_counter() - started
+        body = sender.body
+    finally:
+        containers.put((module, sender))
+
+    if body['Status'] != 'SUCCESS':
+        return { 'stack': stack, 'status': body['Status'], 'priority': None, 'allocate_seconds': allocate_seconds, 'collided': False }
+
+    priority = int(body['Data']['priority'])
+    time.sleep(rule_delay)
+    collided = False
+    try:
+        fake.create_rule(
+            ListenerArn=LISTENER_ARN,
+            Priority=priority,
+            Conditions=[{ 'Field': 'host-header', 'Values': [service_name] }]
+        )
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'PriorityInUse':
+            raise
+        collided = True
+    return { 'stack': stack, 'status': body['Status'], 'priority': priority, 'allocate_seconds': allocate_seconds, 'collided': collided }
+
+def simulate(modules, store_mode, strategy, stacks, rules, latency, store_latency, rule_delay, stagger, seed):
+    """
+    Deploys stacks new services with the given store and strategy, concurrently on the loaded modules
+
+    Returns:
+        (dict) result: collisions, time-to-allocate percentiles and API calls
+    """
+    fake = FakeElbv2(latency)
+    fake.add_listener(LISTENER_ARN, [(priority, 'lcg-svc' + str(priority) + '.lcg.com', None) for priority in range(1, rules + 1)])
+    fake.calls = {}
+
+    stores = []
+    containers = queue.Queue()
+    for module in modules:
+        if store_mode == 'per-container' or not stores:
+            stores.append(CountingReservationStore(module.InMemoryReservationStore(shared=store_mode == 'shared'), store_latency))
+        store = stores[-1]
+        sender = CapturingSender()
+        # A cold container with nothing cached
+        module._clients['elbv2'] = fake
+        module._listener_cache = module.ListenerCache(module.LISTENER_CACHE_MAX_ENTRIES, module.LISTENER_CACHE_TTL_SECONDS)
+        module._reservation_store = store
+        module._response_sender = sender
+        containers.put((module, sender))
+
+    # Stacks start spread over stagger seconds, in a random but repeatable order
+    starts = sorted(random.Random(seed).uniform(0, stagger) for _ in range(stacks))
+    began = time.perf_counter()
+
+    def run(stack):
+        delay = starts[stack] - (time.perf_counter() - began)
+        if delay > 0:
+            time.sleep(delay)
+        return deploy_stack(containers, fake, stack, strategy, rule_delay)
+
+    with ThreadPoolExecutor(max_workers=len(modules)) as executor:
+        outcomes = list(executor.map(run, range(stacks)))
+    elapsed = time.perf_counter() - began
+
+    store_calls = {}
+    for store in stores:
+        for operation, count in store.calls.items():
+            store_calls[operation] = store_calls.get(operation, 0) + count
+
+    allocated = [outcome for outcome in outcomes if outcome['priority'] is not None]
+    collisions = [outcome for outcome in allocated if outcome['collided']]
+    allocate_ms = [outcome['allocate_seconds'] * 1000 for outcome in outcomes]
+    return {
+        'stacks': stacks,
+        'failed': stacks - len(allocated),
+        'collisions': len(collisions),
+        'collision_rate': round(len(collisions) / float(stacks), 4),
+        'distinct_priorities': len(set(outcome['priority'] for outcome in allocated)),
+        'time_to_allocate_ms': {
+            'p50': round(percentile(allocate_ms, 50), 1),
+            'p90': round(percentile(allocate_ms, 90), 1),
+            'p99': round(percentile(allocate_ms, 99), 1),
+            'max': round(max(allocate_ms), 1)
+        },
+        'elbv2_calls': dict(fake.calls),
+        'reservation_calls': store_calls,
+        'elapsed_seconds': round(elapsed, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates concurrent custom resource Creates against one listener")
+    parser.add_argument('--module', default='pipe-deploy', help="handler module, pipe-deploy or code-only")
+    parser.add_argument('--stores', default=','.join(STORES), help="reservation stores to compare, comma separated")
+    parser.add_argument('--strategies', default='lowest,hash', help="allocation strategies to compare, comma separated")
+    parser.add_argument('--stacks', type=int, default=50, help="stacks deploying a new service")
+    parser.add_argument('--concurrency', type=int, default=10, help="Lambda containers running at the same time")
+    parser.add_argument('--rules', type=int, default=100, help="rules already on the listener")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per elbv2 call")
+    parser.add_argument('--store-latency', type=float, default=0.01, help="seconds per reservation call")
+    parser.add_argument('--rule-delay', type=float, default=0.5, help="seconds between a Create's response and its listener rule")
+    parser.add_argument('--stagger', type=float, default=1.0, help="seconds over which the stacks start")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="file to write the JSON results to, instead of stdout")
+    args = parser.parse_args()
+
+    # Reservations stay in memory, never in a real table
+    os.environ.pop('RESERVATION_TABLE', None)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        modules = [load_handler_module(args.module) for _ in range(args.concurrency)]
+
+    results = {}
+    for store_mode in args.stores.split(','):
+        for strategy in args.strategies.split(','):
+            key = store_mode + '/' + strategy
+            # The handlers print what they do, which is not part of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[key] = simulate(
+                    modules, store_mode, strategy, args.stacks, args.rules, args.latency,
+                    args.store_latency, args.rule_delay, args.stagger, args.seed
+                )
+            print(key + ": " + str(results[key]['collisions']) + " collision(s) in " + str(args.stacks) + " stacks", file=sys.stderr)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    main()
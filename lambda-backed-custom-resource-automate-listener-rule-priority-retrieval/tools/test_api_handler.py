@@ -0,0 +1,87 @@
+"""
+Tests of lambda_handler, the API Gateway handler of the code-only module, offline against fake_elbv2.py.
+
+    $ python -m unittest discover tools
+"""
+import json
+import unittest
+
+from fake_elbv2 import FakeElbv2
+from priority_lambda import LambdaContext, call_quietly, load_handler_module
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-infra-ecs-dev/1234/5678'
+
+class ApiHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = call_quietly(load_handler_module, 'code-only')
+        self.fake = FakeElbv2()
+        self.fake.add_listener(LISTENER_ARN, [(1, 'a.lcg.com', '/api/*'), (2, 'b.lcg.com', None)])
+        self.module._clients['elbv2'] = self.fake
+
+    def call(self, params, headers=None, method='GET'):
+        """
+        Calls lambda_handler through an API Gateway proxy event, returns the status code, body and ETag
+        """
+        event = { 'httpMethod': method, 'headers': headers or {} }
+        if method == 'GET':
+            event['queryStringParameters'] = params
+        else:
+            event['body'] = json.dumps(params)
+        response = call_quietly(self.module.lambda_handler, event, LambdaContext())
+        body = json.loads(response['body']) if response['body'] else None
+        return response['statusCode'], body, response['headers'].get('ETag')
+
+    def test_map_and_lookup_agree_on_host_and_path_rules(self):
+        status, body, etag = self.call({ 'listener_arn': LISTENER_ARN })
+        self.assertEqual(body['services'], { 'b.lcg.com': '2' })
+        # a.lcg.com only has a rule with a path, so a host only service is new
+        status, body, etag = self.call({ 'listener_arn': LISTENER_ARN, 'service_name': 'a.lcg.com' })
+        self.assertEqual(body, { 'priority': '3' })
+        status, body, etag = self.call({ 'listener_arn': LISTENER_ARN, 'service_name': 'b.lcg.com' })
+        self.assertEqual(body, { 'priority': '2' })
+
+    def test_lookups_do_not_change_the_map_or_etag(self):
+        status, body, map_etag = self.call({ 'listener_arn': LISTENER_ARN })
+        status, body, etag = self.call({ 'listener_arn': LISTENER_ARN, 'service_names': ['zzz.lcg.com', 'yyy.lcg.com'] })
+        self.assertEqual(body['priorities'], { 'zzz.lcg.com': '3', 'yyy.lcg.com': '4' })
+
+        # No rule was created, the map is the same as before
+        status, body, etag = self.call({ 'listener_arn': LISTENER_ARN })
+        self.assertEqual(body['services'], { 'b.lcg.com': '2' })
+        self.assertEqual(etag, map_etag)
+
+    def test_same_lookup_gets_same_etag_and_304(self):
+        params = { 'listener_arn': LISTENER_ARN, 'service_name': 'new.lcg.com' }
+        status, first, etag = self.call(params)
+        status, second, second_etag = self.call(params)
+        self.assertEqual((first, second_etag), (second, etag))
+
+        status, body, etag = self.call(params, { 'If-None-Match': etag })
+        self.assertEqual((status, body), (304, None))
+
+    def test_post_with_matching_etag_fails_precondition(self):
+        params = { 'listener_arn': LISTENER_ARN, 'service_name': 'b.lcg.com' }
+        status, body, etag = self.call(params, method='POST')
+        self.assertEqual(status, 200)
+        status, body, etag = self.call(params, { 'If-None-Match': etag }, method='POST')
+        self.assertEqual((status, body), (412, None))
+
+    def test_many_services_in_one_call(self):
+        # Comma separated in a query string, a list in a JSON body
+        status, body, etag = self.call({ 'listener_arn': LISTENER_ARN, 'service_names': 'b.lcg.com, new.lcg.com,b.lcg.com' })
+        self.assertEqual(body['priorities'], { 'b.lcg.com': '2', 'new.lcg.com': '3' })
+        status, body, etag = self.call({ 'listener_arn': LISTENER_ARN, 'service_names': ['other.lcg.com', 'new.lcg.com'] }, method='POST')
+        self.assertEqual(body['priorities'], { 'other.lcg.com': '4', 'new.lcg.com': '3' })
+        self.assertEqual(self.fake.calls['describe_rules'], 1)
+
+    def test_bad_requests(self):
+        status, body, etag = self.call({ 'service_name': 'b.lcg.com' })
+        self.assertEqual(status, 400)
+        status, body, etag = self.call({ 'listener_arn': LISTENER_ARN, 'service_names': { 'a': 1 } }, method='POST')
+        self.assertEqual(status, 400)
+        response = call_quietly(self.module.lambda_handler, { 'httpMethod': 'POST', 'body': 'not json' }, LambdaContext())
+        self.assertEqual(response['statusCode'], 400)
+
+if __name__ == "__main__":
+    unittest.main()
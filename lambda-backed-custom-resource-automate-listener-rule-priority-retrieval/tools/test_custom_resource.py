@@ -0,0 +1,260 @@
+"""
+Tests of handler, the custom resource handler of both Lambda modules, offline against fake_elbv2.py.
+
+    $ python -m unittest discover tools
+"""
+import unittest
+
+from fake_elbv2 import FakeElbv2
+from priority_lambda import CapturingSender, HANDLER_MODULES, LambdaContext, call_quietly, load_handler_module, make_event
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-infra-ecs-dev/1234/5678'
+# Two listeners of one load balancer and one of another
+HTTP_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-pool-1/1111/80'
+HTTPS_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-pool-1/1111/443'
+OTHER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-pool-2/2222/443'
+
+class CustomResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modules = [call_quietly(load_handler_module, name) for name in sorted(HANDLER_MODULES)]
+
+    def make_module(self, module, listeners):
+        """
+        Points a module at a fake elbv2 holding the given listeners, {listener_arn: [(priority, host, path)]}
+        """
+        fake = FakeElbv2()
+        for listener_arn, rules in listeners.items():
+            fake.add_listener(listener_arn, rules)
+        module._clients['elbv2'] = fake
+        module._reservation_store = module.InMemoryReservationStore()
+        module._listener_cache = module.ListenerCache(module.LISTENER_CACHE_MAX_ENTRIES, module.LISTENER_CACHE_TTL_SECONDS)
+        module._response_sender = CapturingSender()
+        return fake
+
+    def create(self, module, properties):
+        """
+        Sends a Create for the properties and returns the response sent to CloudFormation
+        """
+        call_quietly(module.handler, make_event('Create', properties), LambdaContext())
+        return module._response_sender.body
+
+    def test_invalid_service_names_fail(self):
+        invalid = [
+            'a.lcg.com',
+            [],
+            [5],
+            ['a.lcg.com', 'a.lcg.com'],
+            # The same service with another path, both named after the service
+            [{ 'service_name': 'a.lcg.com', 'path': '/api/*' }, { 'service_name': 'a.lcg.com', 'path': '/web/*' }],
+        ]
+        for module in self.modules:
+            for service_names in invalid:
+                with self.subTest(module=module.__name__, service_names=service_names):
+                    self.make_module(module, { LISTENER_ARN: [(1, 'b.lcg.com', None)] })
+                    response = self.create(module, { 'listener_arn': LISTENER_ARN, 'service_names': service_names })
+                    self.assertEqual(response['Status'], 'FAILED')
+                    self.assertIn('service_names', response['Data']['Message'])
+
+    def test_services_with_paths_get_a_priority_each(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.make_module(module, { LISTENER_ARN: [(1, 'b.lcg.com', None)] })
+                response = self.create(module, { 'listener_arn': LISTENER_ARN, 'service_names': [
+                    { 'name': 'api', 'service_name': 'a.lcg.com', 'path': '/api/*' },
+                    { 'name': 'web', 'service_name': 'a.lcg.com', 'path': '/web/*' },
+                    'b.lcg.com',
+                ] })
+                self.assertEqual(response['Status'], 'SUCCESS')
+                self.assertEqual(response['Data'], { 'api': '2', 'web': '3', 'b.lcg.com': '1' })
+
+    def test_cache_writes_through_new_priorities(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                fake = self.make_module(module, { LISTENER_ARN: [(1, 'b.lcg.com', None)] })
+                fake.calls = {}
+                for service_name, priority in (('new1.lcg.com', '2'), ('new2.lcg.com', '3'), ('new1.lcg.com', '2')):
+                    response = self.create(module, { 'listener_arn': LISTENER_ARN, 'service_name': service_name })
+                    self.assertEqual(response['Data'], { 'priority': priority })
+                # The listener was read once, the priorities handed out since were added to the cached copy
+                self.assertEqual(fake.calls['describe_rules'], 1)
+
+                # Once it expires the listener is read again, where the new rules were never created
+                module._listener_cache = module.ListenerCache(module.LISTENER_CACHE_MAX_ENTRIES, 0)
+                module._reservation_store = module.InMemoryReservationStore()
+                response = self.create(module, { 'listener_arn': LISTENER_ARN, 'service_name': 'new2.lcg.com' })
+                self.assertEqual(response['Data'], { 'priority': '2' })
+                self.assertEqual(fake.calls['describe_rules'], 2)
+
+    def test_several_listeners_get_the_same_priority(self):
+        listeners = {
+            HTTP_ARN: [(1, 'a.lcg.com', None), (2, 'b.lcg.com', None), (5, 'd.lcg.com', None)],
+            HTTPS_ARN: [(1, 'a.lcg.com', None), (3, 'c.lcg.com', None), (5, 'e.lcg.com', None)],
+        }
+        expected = {
+            # Free on both
+            'new.lcg.com': '4',
+            'a.lcg.com': '1',
+            # Only on one listener, with its priority free on the other
+            'b.lcg.com': '2',
+            'c.lcg.com': '3',
+            # Its priority is another service's on the other listener
+            'd.lcg.com': '4',
+        }
+        for module in self.modules:
+            for service_name, priority in expected.items():
+                with self.subTest(module=module.__name__, service_name=service_name):
+                    self.make_module(module, listeners)
+                    response = self.create(module, { 'listener_arn': [HTTP_ARN, HTTPS_ARN], 'service_name': service_name })
+                    self.assertEqual(response['Data'], { 'priority': priority })
+
+    def test_allocation_options(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.assertEqual(module.get_allocation_options({}), ('lowest', (1, module.MAX_RULE_PRIORITY)))
+                self.assertEqual(module.get_allocation_options({ 'allocation_strategy': 'hash', 'priority_band': '1000-1999' }), ('hash', (1000, 1999)))
+                self.assertEqual(module.get_allocation_options({ 'priority_band': ['1000', '1999'] }), ('lowest', (1000, 1999)))
+                for properties in ({ 'allocation_strategy': 'random' }, { 'priority_band': 'abc' }, { 'priority_band': '5-1' },
+                                   { 'priority_band': '0-10' }, { 'priority_band': '1-' + str(module.MAX_RULE_PRIORITY + 1) }):
+                    with self.assertRaises(ValueError):
+                        module.get_allocation_options(properties)
+
+    def test_lowest_priority_inside_the_band(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.make_module(module, { LISTENER_ARN: [(1, 'a.lcg.com', None), (1000, 'b.lcg.com', None)] })
+                response = self.create(module, { 'listener_arn': LISTENER_ARN, 'service_name': 'new.lcg.com', 'priority_band': '1000-1999' })
+                self.assertEqual(response['Data'], { 'priority': '1001' })
+
+    def test_hash_prefers_the_same_priority_everywhere(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                preferred = module.get_hashed_priority('new.lcg.com', 100, 109)
+                self.assertTrue(100 <= preferred <= 109)
+                properties = { 'listener_arn': LISTENER_ARN, 'service_name': 'new.lcg.com', 'allocation_strategy': 'hash', 'priority_band': '100-109' }
+
+                self.make_module(module, { LISTENER_ARN: [] })
+                self.assertEqual(self.create(module, properties)['Data'], { 'priority': str(preferred) })
+
+                # Taken, the next one up, wrapping around to the start of the band
+                self.make_module(module, { LISTENER_ARN: [(preferred, 'other.lcg.com', None)] })
+                self.assertEqual(self.create(module, properties)['Data'], { 'priority': str(preferred + 1 if preferred < 109 else 100) })
+
+                # Every priority of the band is taken
+                self.make_module(module, { LISTENER_ARN: [(priority, 'svc' + str(priority) + '.lcg.com', None) for priority in range(100, 110)] })
+                response = self.create(module, properties)
+                self.assertEqual(response['Status'], 'FAILED')
+                self.assertIn('priority_band 100-109', response['Data']['Message'])
+
+    def make_pool(self, module):
+        """
+        3 rules on each listener of the first load balancer, 4 on the second
+        """
+        return self.make_module(module, {
+            HTTP_ARN: [(priority, 'http' + str(priority) + '.lcg.com', None) for priority in range(1, 4)],
+            HTTPS_ARN: [(priority, 'https' + str(priority) + '.lcg.com', None) for priority in range(1, 4)],
+            OTHER_ARN: [(priority, 'other' + str(priority) + '.lcg.com', None) for priority in range(1, 5)],
+        })
+
+    def test_invalid_pool_options_fail(self):
+        invalid = [
+            { 'listener_pool': HTTP_ARN },
+            { 'listener_pool': [] },
+            { 'listener_pool': [HTTP_ARN], 'rule_quota': 'abc' },
+            { 'listener_pool': [HTTP_ARN], 'rule_quota': '0' },
+            { 'listener_pool': [HTTP_ARN], 'sticky': 'yes' },
+        ]
+        for module in self.modules:
+            for properties in invalid:
+                with self.subTest(module=module.__name__, properties=properties):
+                    self.make_pool(module)
+                    properties = dict(properties, service_name='new.lcg.com')
+                    response = self.create(module, properties)
+                    self.assertEqual(response['Status'], 'FAILED')
+
+    def test_pool_picks_the_load_balancer_with_fewest_rules(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.make_pool(module)
+                # Each listener of the first load balancer has fewer rules, but it has 6 rules in all
+                response = self.create(module, { 'listener_pool': [HTTP_ARN, HTTPS_ARN, OTHER_ARN], 'service_name': 'new.lcg.com' })
+                self.assertEqual(response['Data'], { 'priority': '5', 'listener_arn': OTHER_ARN })
+
+    def test_pool_keeps_existing_services_on_their_listener(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.make_pool(module)
+                response = self.create(module, { 'listener_pool': [HTTP_ARN, HTTPS_ARN, OTHER_ARN], 'service_name': 'https2.lcg.com' })
+                self.assertEqual(response['Data'], { 'priority': '2', 'listener_arn': HTTPS_ARN })
+                response = self.create(module, { 'listener_pool': [HTTP_ARN, HTTPS_ARN, OTHER_ARN], 'service_name': 'https2.lcg.com', 'sticky': 'false' })
+                self.assertEqual(response['Data'], { 'priority': '5', 'listener_arn': OTHER_ARN })
+
+    def test_pool_fails_when_every_load_balancer_is_at_its_quota(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.make_pool(module)
+                properties = { 'listener_pool': [HTTP_ARN, HTTPS_ARN, OTHER_ARN], 'rule_quota': '5' }
+                response = self.create(module, dict(properties, service_name='new.lcg.com'))
+                self.assertEqual(response['Data']['listener_arn'], OTHER_ARN)
+                # 6 + 2 rules on the first load balancer, 5 + 2 on the second
+                response = self.create(module, dict(properties, service_names=['new1.lcg.com', 'new2.lcg.com']))
+                self.assertEqual(response['Status'], 'FAILED')
+                self.assertIn('rule quota of 5', response['Data']['Message'])
+
+    def test_physical_resource_id_holds_the_priorities(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                properties = { 'listener_pool': [HTTP_ARN, OTHER_ARN], 'service_names': ['a.lcg.com', 'b.lcg.com'] }
+                physical_resource_id = module.encode_physical_resource_id(properties, 1, [7, 12])
+                digest, listener_index, priorities = module.decode_physical_resource_id(physical_resource_id)
+                self.assertEqual((listener_index, priorities), (1, [7, 12]))
+                self.assertEqual(digest, module.get_properties_digest(dict(properties, ServiceToken='another')))
+                for other in (None, 'FakeInfo-1234', physical_resource_id + ':5', physical_resource_id.replace(':1:', ':x:')):
+                    self.assertIsNone(module.decode_physical_resource_id(other))
+
+    def test_unchanged_update_does_not_read_the_listener(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                fake = self.make_module(module, { LISTENER_ARN: [(1, 'b.lcg.com', None)] })
+                properties = { 'listener_arn': LISTENER_ARN, 'service_names': ['a.lcg.com', 'b.lcg.com'] }
+                created = self.create(module, properties)
+                fake.calls = {}
+
+                call_quietly(module.handler, make_event('Update', properties, created['PhysicalResourceId']), LambdaContext())
+                updated = module._response_sender.body
+                self.assertEqual((updated['Status'], updated['Data']), ('SUCCESS', created['Data']))
+                self.assertEqual(updated['PhysicalResourceId'], created['PhysicalResourceId'])
+                self.assertEqual(fake.calls, {})
+
+                # Changed properties are allocated again
+                event = make_event('Update', dict(properties, service_names=['c.lcg.com']), created['PhysicalResourceId'])
+                event['OldResourceProperties'] = properties
+                call_quietly(module.handler, event, LambdaContext())
+                self.assertEqual(module._response_sender.body['Data'], { 'c.lcg.com': '3' })
+
+    def test_delete_releases_reservations(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.make_module(module, { LISTENER_ARN: [(1, 'b.lcg.com', None)] })
+                properties = { 'listener_arn': LISTENER_ARN, 'service_name': 'a.lcg.com' }
+                created = self.create(module, properties)
+                store = module._reservation_store
+                self.assertFalse(store.reserve(LISTENER_ARN, 2, 'other.lcg.com', 60))
+
+                call_quietly(module.handler, make_event('Delete', properties, created['PhysicalResourceId']), LambdaContext())
+                self.assertEqual(module._response_sender.body['Status'], 'SUCCESS')
+                self.assertTrue(store.reserve(LISTENER_ARN, 2, 'other.lcg.com', 60))
+
+    def test_delete_without_reservation_table_builds_no_store(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.make_module(module, {})
+                module._reservation_store = None
+                module.RESERVATION_TABLE = ''
+                physical_resource_id = module.encode_physical_resource_id({ 'listener_arn': LISTENER_ARN, 'service_name': 'a.lcg.com' }, 0, [2])
+                call_quietly(module.handler, make_event('Delete', { 'listener_arn': LISTENER_ARN, 'service_name': 'a.lcg.com' }, physical_resource_id), LambdaContext())
+                self.assertEqual(module._response_sender.body['Status'], 'SUCCESS')
+                self.assertIsNone(module._reservation_store)
+
+if __name__ == "__main__":
+    unittest.main()
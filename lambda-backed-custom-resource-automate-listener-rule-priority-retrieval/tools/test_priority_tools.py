@@ -0,0 +1,77 @@
+"""
+Tests of compact-listener-rule-priorities.py, offline against fake_elbv2.py.
+
+    $ python -m unittest discover tools
+"""
+import importlib.util
+import os
+import unittest
+
+from fake_elbv2 import FakeElbv2
+from priority_lambda import call_quietly
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-infra-ecs-dev/1234/5678'
+
+def load_compaction_tool():
+    """
+    Loads compact-listener-rule-priorities.py, whose name is not a python module name
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compact-listener-rule-priorities.py')
+    spec = importlib.util.spec_from_file_location('compact_listener_rule_priorities', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class CompactionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tool = call_quietly(load_compaction_tool)
+
+    def make_listener(self, priorities):
+        fake = FakeElbv2()
+        fake.add_listener(LISTENER_ARN, [(priority, 'svc' + str(priority) + '.lcg.com', None) for priority in priorities])
+        fake.calls = {}
+        return fake
+
+    def hosts_in_order(self, fake):
+        snapshot = self.tool.lambda_module.ListenerRuleSnapshot.fetch(fake, LISTENER_ARN)
+        return [snapshot.condition_index().service_by_priority[priority] for priority in sorted(snapshot.priorities)]
+
+    def compact(self, fake, start, step, batch_size):
+        snapshot = self.tool.lambda_module.ListenerRuleSnapshot.fetch(fake, LISTENER_ARN)
+        moves = self.tool.plan_compaction(snapshot, start, step)
+        batches = self.tool.batch_moves(moves, batch_size)
+        fake.calls = {}
+        # A move landing on a priority still in use raises PriorityInUse
+        call_quietly(self.tool.apply_plan, fake, batches)
+        return moves, batches
+
+    def test_keeps_order_in_any_batch_size(self):
+        priorities = [3, 7, 8, 20, 21, 22, 50, 51, 300, 1000]
+        for start, step in ((1, 1), (10, 10), (100, 1)):
+            for batch_size in (1, 3, 100):
+                with self.subTest(start=start, step=step, batch_size=batch_size):
+                    fake = self.make_listener(priorities)
+                    before = self.hosts_in_order(fake)
+                    moves, batches = self.compact(fake, start, step, batch_size)
+
+                    self.assertEqual(self.hosts_in_order(fake), before)
+                    self.assertEqual(fake.priorities(LISTENER_ARN), list(range(start, start + len(priorities) * step, step)))
+                    self.assertEqual(len(batches), -(-len(moves) // batch_size))
+                    self.assertEqual(fake.calls.get('set_rule_priorities', 0), len(batches))
+
+    def test_compacted_listener_has_nothing_to_move(self):
+        fake = self.make_listener([1, 2, 3])
+        moves, batches = self.compact(fake, 1, 1, 100)
+        self.assertEqual(moves, [])
+        self.assertEqual(fake.calls, {})
+
+    def test_refuses_to_go_past_the_priority_limit(self):
+        fake = self.make_listener([1, 2, 3])
+        snapshot = self.tool.lambda_module.ListenerRuleSnapshot.fetch(fake, LISTENER_ARN)
+        with self.assertRaises(ValueError):
+            self.tool.plan_compaction(snapshot, self.tool.lambda_module.MAX_RULE_PRIORITY - 1, 1)
+
+if __name__ == "__main__":
+    unittest.main()
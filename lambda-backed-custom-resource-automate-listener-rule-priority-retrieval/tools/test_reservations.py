@@ -0,0 +1,106 @@
+"""
+Tests of the priority reservations of both Lambda modules, offline against fake_elbv2.py.
+
+    $ python -m unittest discover tools
+"""
+import threading
+import unittest
+
+from fake_elbv2 import FakeElbv2
+from priority_lambda import CapturingSender, HANDLER_MODULES, LambdaContext, call_quietly, load_handler_module, make_event
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-infra-ecs-dev/1234/5678'
+
+class ReservationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modules = [call_quietly(load_handler_module, name) for name in sorted(HANDLER_MODULES)]
+
+    def test_lease_is_held_by_one_service(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                store = module.InMemoryReservationStore()
+                self.assertTrue(store.reserve(LISTENER_ARN, 5, 'a.lcg.com', 60))
+                self.assertFalse(store.reserve(LISTENER_ARN, 5, 'b.lcg.com', 60))
+                # A retried request gets its priority back
+                self.assertTrue(store.reserve(LISTENER_ARN, 5, 'a.lcg.com', 60))
+                store.release(LISTENER_ARN, 5, 'b.lcg.com')
+                self.assertFalse(store.reserve(LISTENER_ARN, 5, 'b.lcg.com', 60))
+                store.release(LISTENER_ARN, 5, 'a.lcg.com')
+                self.assertTrue(store.reserve(LISTENER_ARN, 5, 'b.lcg.com', 60))
+
+    def test_expired_lease_can_be_taken(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                store = module.InMemoryReservationStore()
+                self.assertTrue(store.reserve(LISTENER_ARN, 5, 'a.lcg.com', -1))
+                self.assertTrue(store.reserve(LISTENER_ARN, 5, 'b.lcg.com', 60))
+
+    def test_store_must_implement_reserve_and_release(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                class ReserveOnly(module.PriorityReservationStore):
+                    def reserve(self, listener_arn, priority, service_name, ttl):
+                        return True
+                for store_class in (module.PriorityReservationStore, ReserveOnly):
+                    with self.assertRaises(TypeError):
+                        store_class()
+
+    def allocate_side_by_side(self, module, stores):
+        """
+        Allocates a new service per store at the same time, each from its own read of the listener
+        """
+        fake = FakeElbv2()
+        fake.add_listener(LISTENER_ARN, [(priority, 'svc' + str(priority) + '.lcg.com', None) for priority in range(1, 11)])
+        snapshots = [module.ListenerRuleSnapshot.fetch(fake, LISTENER_ARN) for _ in stores]
+        priorities = [None] * len(stores)
+        barrier = threading.Barrier(len(stores))
+
+        def allocate(i):
+            services = [('priority', 'new' + str(i) + '.lcg.com', None)]
+            barrier.wait()
+            priorities[i] = module.allocate_service_priorities([snapshots[i]], services, stores[i])['priority']
+
+        def run_all():
+            threads = [threading.Thread(target=allocate, args=(i,)) for i in range(len(stores))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        call_quietly(run_all)
+        return priorities
+
+    def test_shared_store_never_hands_out_the_same_priority(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                store = module.InMemoryReservationStore()
+                priorities = self.allocate_side_by_side(module, [store] * 8)
+                self.assertEqual(len(set(priorities)), 8)
+                self.assertTrue(all(priority > 10 for priority in priorities))
+
+    def test_stores_of_their_own_collide(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                priorities = self.allocate_side_by_side(module, [module.InMemoryReservationStore() for _ in range(8)])
+                self.assertEqual(set(priorities), {11})
+
+    def test_unshared_store_fails_new_services(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                fake = FakeElbv2()
+                fake.add_listener(LISTENER_ARN, [(1, 'a.lcg.com', None)])
+                sender = CapturingSender()
+                module._clients['elbv2'] = fake
+                module._reservation_store = module.InMemoryReservationStore(shared=False)
+                module._response_sender = sender
+
+                call_quietly(module.handler, make_event('Create', { 'listener_arn': LISTENER_ARN, 'service_name': 'new.lcg.com' }), LambdaContext())
+                self.assertEqual(sender.body['Status'], 'FAILED')
+                # An existing service cannot collide, it keeps its priority
+                call_quietly(module.handler, make_event('Create', { 'listener_arn': LISTENER_ARN, 'service_name': 'a.lcg.com' }), LambdaContext())
+                self.assertEqual(sender.body['Status'], 'SUCCESS')
+                self.assertEqual(sender.body['Data']['priority'], '1')
+
+if __name__ == "__main__":
+    unittest.main()
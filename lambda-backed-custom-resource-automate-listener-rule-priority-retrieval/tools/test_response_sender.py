@@ -0,0 +1,83 @@
+"""
+Tests of the ResponseSender of both Lambda modules, against a local HTTP server standing in for the ResponseURL.
+
+    $ python -m unittest discover tools
+"""
+import socket
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from priority_lambda import HANDLER_MODULES, call_quietly, load_handler_module
+
+class FlakyResponseHandler(BaseHTTPRequestHandler):
+    """
+    Answers PUTs with the statuses of the server in turn, then 200
+    """
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.bodies.append(self.path)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class ResponseSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FlakyResponseHandler)
+        self.server.statuses = []
+        self.server.bodies = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:' + str(self.server.server_port) + '/response'
+        self.modules = [call_quietly(load_handler_module, name) for name in sorted(HANDLER_MODULES)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def send(self, module, url, max_attempts=3):
+        sender = module.ResponseSender(1, 1, max_attempts, base_delay=0.01, max_delay=0.01)
+        status = call_quietly(sender.send, url, b'{}')
+        return status, [attempt['status'] for attempt in sender.attempts]
+
+    def test_retries_5xx(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.server.statuses = [503, 502]
+                self.server.bodies = []
+                self.assertEqual(self.send(module, self.url), (200, [503, 502, 200]))
+                self.assertEqual(len(self.server.bodies), 3)
+
+    def test_gives_up_after_max_attempts(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.server.statuses = [500, 500, 500, 500]
+                self.server.bodies = []
+                self.assertEqual(self.send(module, self.url), (500, [500, 500, 500]))
+                self.assertEqual(len(self.server.bodies), 3)
+
+    def test_does_not_retry_4xx(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.server.statuses = [403]
+                self.server.bodies = []
+                self.assertEqual(self.send(module, self.url), (403, [403]))
+
+    def test_no_response_is_minus_one(self):
+        # A port nothing listens on
+        with socket.socket() as unused:
+            unused.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:' + str(unused.getsockname()[1]) + '/response'
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.assertEqual(self.send(module, url, max_attempts=2), (-1, [-1, -1]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests of the indexes both Lambda modules build on a listener's rules, FreePriorityIndex and RuleConditionIndex.
+
+    $ python -m unittest discover tools
+"""
+import unittest
+
+from fake_elbv2 import FakeElbv2
+from priority_lambda import HANDLER_MODULES, call_quietly, load_handler_module
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:FakeAccount123:listener/app/lcg-infra-ecs-dev/1234/5678'
+
+def make_rule(priority, conditions):
+    return { 'RuleArn': 'rule-' + str(priority), 'Priority': str(priority), 'Conditions': conditions }
+
+class RuleConditionIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modules = [call_quietly(load_handler_module, name) for name in sorted(HANDLER_MODULES)]
+
+    def test_every_host_and_path_of_a_rule_is_indexed(self):
+        rules = [
+            # Legacy Values and the *Config form, values found in both are only counted once
+            make_rule(3, [
+                { 'Field': 'host-header', 'Values': ['a.lcg.com'], 'HostHeaderConfig': { 'Values': ['a.lcg.com', 'www.a.lcg.com'] } },
+            ]),
+            make_rule(5, [
+                { 'Field': 'host-header', 'HostHeaderConfig': { 'Values': ['b.lcg.com'] } },
+                { 'Field': 'path-pattern', 'PathPatternConfig': { 'Values': ['/api/*', '/v2/*'] } },
+                { 'Field': 'http-request-method', 'HttpRequestMethodConfig': { 'Values': ['GET'] } },
+            ]),
+            { 'RuleArn': 'default', 'Priority': 'default', 'Conditions': [], 'IsDefault': True },
+        ]
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.assertEqual(module.get_condition_values(rules[0]), (['a.lcg.com', 'www.a.lcg.com'], []))
+                index = module.RuleConditionIndex(rules)
+                self.assertEqual(index.lookup('a.lcg.com'), ('rule-3', 3))
+                self.assertEqual(index.lookup('www.a.lcg.com'), ('rule-3', 3))
+                self.assertEqual(index.lookup('b.lcg.com', '/api/*'), ('rule-5', 5))
+                self.assertEqual(index.lookup('b.lcg.com', '/v2/*'), ('rule-5', 5))
+                # A host+path rule is not the host only service
+                self.assertIsNone(index.lookup('b.lcg.com'))
+                self.assertIsNone(index.lookup('a.lcg.com', '/api/*'))
+                self.assertEqual(index.service_by_priority, { 3: 'a.lcg.com', 5: 'b.lcg.com' })
+
+    def test_lowest_priority_wins(self):
+        rules = [
+            make_rule(9, [{ 'Field': 'host-header', 'Values': ['a.lcg.com'] }]),
+            make_rule(4, [{ 'Field': 'host-header', 'Values': ['a.lcg.com'] }]),
+            make_rule(6, [{ 'Field': 'host-header', 'Values': ['a.lcg.com'] }]),
+        ]
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                self.assertEqual(module.RuleConditionIndex(rules).lookup('a.lcg.com'), ('rule-4', 4))
+
+    def test_snapshot_reads_every_page(self):
+        fake = FakeElbv2()
+        fake.add_listener(LISTENER_ARN, [(priority, 'svc' + str(priority) + '.lcg.com', None) for priority in range(1, 52)])
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                fake.calls = {}
+                module.DESCRIBE_RULES_PAGE_SIZE = 20
+                snapshot = module.ListenerRuleSnapshot.fetch(fake, LISTENER_ARN)
+                self.assertEqual(sorted(snapshot.priorities), list(range(1, 52)))
+                # 51 rules and the default rule
+                self.assertEqual((snapshot.api_calls, fake.calls['describe_rules']), (3, 3))
+                self.assertEqual(module.get_service_priority('svc51.lcg.com', snapshot), 51)
+
+class FreePriorityIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modules = [call_quietly(load_handler_module, name) for name in sorted(HANDLER_MODULES)]
+
+    def test_first_free_inside_a_band(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                index = module.FreePriorityIndex([1, 2, 4, 10, 11, module.MAX_RULE_PRIORITY])
+                self.assertEqual(index.first_free(), 3)
+                self.assertEqual(index.first_free(10, 20), 12)
+                self.assertEqual(index.first_free(10, 11), -1)
+                self.assertEqual(index.first_free(module.MAX_RULE_PRIORITY), -1)
+                self.assertEqual(index.used_count(), 6)
+                index.release(4)
+                self.assertTrue(index.is_free(4))
+                self.assertFalse(index.is_free(0))
+
+    def test_intersection_is_free_on_every_listener(self):
+        for module in self.modules:
+            with self.subTest(module=module.__name__):
+                first = module.FreePriorityIndex([1, 2, 5])
+                second = module.FreePriorityIndex([3, 4])
+                merged = module.FreePriorityIndex.intersect([first, second])
+                self.assertEqual(merged.first_free(), 6)
+                self.assertEqual(merged.used_count(), 5)
+                # The indexes themselves are left as they were
+                self.assertEqual((first.first_free(), second.first_free()), (3, 1))
+                self.assertIs(module.FreePriorityIndex.intersect([first]), first)
+
+if __name__ == "__main__":
+    unittest.main()
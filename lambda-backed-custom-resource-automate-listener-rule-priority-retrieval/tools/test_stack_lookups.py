@@ -0,0 +1,87 @@
+"""
+Tests of find_stacks, the stack lookups of the code-only module, against an in-memory CloudFormation client.
+
+    $ python -m unittest discover tools
+"""
+import unittest
+
+from botocore.exceptions import ClientError
+
+from priority_lambda import call_quietly, load_handler_module
+
+class FakeCloudFormation:
+    """
+    Stacks by name and status, answering describe_stacks and list_stacks (two stacks a page) and counting the calls
+    """
+
+    class exceptions:
+        ClientError = ClientError
+
+    def __init__(self, stacks, throttled=False):
+        self.stacks = stacks
+        self.throttled = throttled
+        self.calls = {}
+
+    def _count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def describe_stacks(self, StackName):
+        self._count('describe_stacks')
+        if self.throttled:
+            raise ClientError({ 'Error': { 'Code': 'Throttling', 'Message': 'Rate exceeded' } }, 'DescribeStacks')
+        # Like CloudFormation, a deleted stack is only found by its stack id
+        if self.stacks.get(StackName, 'DELETE_COMPLETE') == 'DELETE_COMPLETE':
+            raise ClientError({ 'Error': { 'Code': 'ValidationError', 'Message': 'Stack with id ' + StackName + ' does not exist' } }, 'DescribeStacks')
+        return { 'Stacks': [{ 'StackName': StackName, 'StackStatus': self.stacks[StackName] }] }
+
+    def list_stacks(self, StackStatusFilter, NextToken=None):
+        self._count('list_stacks')
+        summaries = [{ 'StackName': name, 'StackStatus': status } for name, status in sorted(self.stacks.items()) if status in StackStatusFilter]
+        start = int(NextToken or 0)
+        response = { 'StackSummaries': summaries[start:start + 2] }
+        if start + 2 < len(summaries):
+            response['NextToken'] = str(start + 2)
+        return response
+
+class FindStacksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = call_quietly(load_handler_module, 'code-only')
+        self.cloudformation = FakeCloudFormation({
+            'a-stack': 'CREATE_COMPLETE',
+            'b-stack': 'UPDATE_COMPLETE',
+            'c-stack': 'DELETE_COMPLETE',
+            'd-stack': 'ROLLBACK_COMPLETE',
+            'e-stack': 'UPDATE_ROLLBACK_COMPLETE',
+        })
+        self.module._clients['cloudformation'] = self.cloudformation
+
+    def find(self, stack_names):
+        self.cloudformation.calls = {}
+        return call_quietly(self.module.find_stacks, stack_names)
+
+    def test_one_stack_is_one_describe_stacks_call(self):
+        for stack_name, exists in (('a-stack', True), ('c-stack', False), ('d-stack', False), ('no-stack', False)):
+            with self.subTest(stack_name=stack_name):
+                self.assertEqual(self.find([stack_name]), { stack_name: exists })
+                self.assertEqual(self.cloudformation.calls, { 'describe_stacks': 1 })
+                # Then taken from the cache
+                self.assertEqual(self.find([stack_name]), { stack_name: exists })
+                self.assertEqual(self.cloudformation.calls, {})
+
+    def test_throttled_describe_falls_back_to_list_stacks(self):
+        self.cloudformation.throttled = True
+        self.assertEqual(self.find(['b-stack']), { 'b-stack': True })
+        self.assertEqual(self.cloudformation.calls, { 'describe_stacks': 1, 'list_stacks': 1 })
+
+    def test_many_stacks_stop_listing_once_found(self):
+        self.assertEqual(self.find(['a-stack', 'b-stack']), { 'a-stack': True, 'b-stack': True })
+        self.assertEqual(self.cloudformation.calls, { 'list_stacks': 1 })
+
+        found = self.find(['a-stack', 'c-stack', 'e-stack', 'no-stack'])
+        self.assertEqual(found, { 'a-stack': True, 'c-stack': False, 'e-stack': True, 'no-stack': False })
+        # Stacks not found are only known once every page is read
+        self.assertEqual(self.cloudformation.calls, { 'list_stacks': 2 })
+
+if __name__ == "__main__":
+    unittest.main()
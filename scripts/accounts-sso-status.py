@@ -1,9 +1,14 @@
+import argparse
 import csv
 import sys
 from datetime import date
 
 import boto3
-from botocore.exceptions import ClientError
+
+from credential_cache import CredentialCache, client_config
+from rate_control import get_throttle_counts, rate_controlled
+from scan_engine import DEFAULT_WORKERS, scan_accounts
+from scan_journal import ScanJournal
 
 # Fancy colouring
 class bcolors:
@@ -34,6 +39,13 @@ def write_csv(result):
     print(bcolors.HEADER + "Wrote to output file " + bcolors.UNDERLINE + outputfilename + bcolors.ENDC)
 
 def main():
+
+    parser = argparse.ArgumentParser(description="Lists whether each account in a file is under AWS SSO")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="accounts scanned at the same time (default " + str(DEFAULT_WORKERS) + ")")
+    parser.add_argument('--credential-cache', metavar='FILE', help="file to keep the assumed role credentials in between runs, readable by its owner only (default: memory only)")
+    parser.add_argument('--journal', default='accounts-sso-status.journal', help="file each account's result is recorded in as soon as it is scanned (default accounts-sso-status.journal)")
+    parser.add_argument('--resume', action='store_true', help="keep the accounts already scanned in the journal, and only scan the others and those which failed")
+    args = parser.parse_args()
         
     # Get input from the user
     start_msg = """
@@ -56,7 +68,7 @@ def main():
     aws_accounts_input = input('Enter name of file containing AWS accounts to process e.g. accounts.txt: ')
 
     print()
-    print(bcolors.HEADER + "Going through all accounts in the file..." + bcolors.ENDC)  
+    print(bcolors.HEADER + "Going through all accounts in the file, " + str(args.workers) + " at a time..." + bcolors.ENDC)  
 
     # Prepare CSV file results
     errorCount = 0
@@ -67,11 +79,42 @@ def main():
     # Open the file and read all lines
     file = open(aws_accounts_input, 'r')
     lines = file.readlines()
-    i = 0
-    n = len(lines)
-    for line in lines:
-        account = line.strip()
-        account_result, success, errors, i = process_account(i, n, account, role)
+    accounts = [line.strip() for line in lines]
+
+    # Accounts already scanned by the run being resumed are not scanned again
+    # A journal of a scan with another role or options is not resumed from, its results would not match this one's
+    try:
+        journal = ScanJournal(args.journal, args.resume, { 'Role': role })
+    except ValueError as err:
+        print(bcolors.FAIL + str(err) + bcolors.ENDC)
+        return
+    pending = [account for account in accounts if account not in journal.completed]
+    if args.resume:
+        print(bcolors.HEADER + "Resuming from " + bcolors.UNDERLINE + args.journal + bcolors.ENDC + bcolors.HEADER + ", " + str(len(accounts) - len(pending)) + " account(s) already scanned, " + str(len(journal.errored)) + " failed account(s) to retry" + bcolors.ENDC)
+
+    # Process the accounts side by side, and print out a progress bar while doing it
+    # One STS client for all of them, boto3 clients are thread safe but creating them is not
+    # Credentials of each account are kept until they are about to expire, its client is closed once it is scanned, see credential_cache.py
+    # Every client goes through a rate limiter shared by its service, which also retries throttled calls
+    sts = rate_controlled(boto3.client('sts', config=client_config(args.workers)))
+    credentials = CredentialCache(sts, 'accounts-sso-status-script', args.credential_cache, rate_controlled)
+    try:
+        scanned = scan_accounts(
+            pending,
+            lambda account: process_account(credentials, account, role),
+            account_error,
+            args.workers,
+            print_progress,
+            # Recorded as each account finishes, so a scan which dies can be resumed with --resume
+            lambda account, scan_result: journal.record(account, scan_result, scan_result[2] > 0)
+        )
+    finally:
+        # Saved even if the scan dies, so running it again with --resume does not assume the roles again
+        credentials.save()
+    journal.close()
+    scanned = dict(zip(pending, scanned))
+    for account in accounts:
+        account_result, success, errors = journal.completed[account] if account in journal.completed else scanned[account]
         result.extend(account_result)
         successCount = successCount + success
         errorCount = errorCount + errors
@@ -82,6 +125,9 @@ def main():
     print()
     print(bcolors.OKGREEN + str(successCount) + " Successful ✔️ " + bcolors.ENDC)
     print(bcolors.FAIL + str(errorCount) + " Error(s) ❗ " + bcolors.ENDC)
+    for service_name, throttles in sorted(get_throttle_counts().items()):
+        print(bcolors.WARNING + str(throttles) + " throttled " + service_name + " call(s), slowed down and retried" + bcolors.ENDC)
+    print(bcolors.HEADER + str(credentials.assumed) + " role(s) assumed, " + str(credentials.reused) + " reused" + bcolors.ENDC)
     
     # Write the results to a CSV file
     write_csv(result)
@@ -119,39 +165,27 @@ def main():
     """
     print(bcolors.OKGREEN + done_msg + bcolors.ENDC)
 
-def process_account(i, n, account_id, role):
+def process_account(credentials, account_id, role):
     """
-    Given i, n, account_id and role, returns aws sso status, success and failure counts, and status of progress
+    Given the CredentialCache, account_id and role, returns aws sso status, success and failure counts.
+    Runs on a worker thread, a ClientError is turned into the account's result by account_error.
     """
-
-    # Print a nice progress bar
-    print_progress(i, n)
-    i = i + 1
-
-    result = []
-    successCount = 0
-    errorCount = 0
-
-    client = boto3.client('sts')
-    rolearn = 'arn:aws:iam::' + account_id + ':role/'+ role
-
+    # Assume the role unless credentials of it are kept, if the role does not exist, this will simply fail
+    iam = credentials.client(account_id, role, 'iam')
     try:
-        # Assume the role, if the role does not exist, this will simply fail
-        response = client.assume_role(RoleArn=rolearn, RoleSessionName='accounts-sso-status-script')
-        session = boto3.Session(aws_access_key_id=response['Credentials']['AccessKeyId'],aws_secret_access_key=response['Credentials']['SecretAccessKey'],aws_session_token=response['Credentials']['SessionToken'])
-        
         # Get Alias and SAML providers
-        alias, awssso, saml, samlinfo = get_alias_and_saml_providers(session)
+        alias, awssso, saml, samlinfo = get_alias_and_saml_providers(iam)
+    finally:
+        # Its connections are not needed for the other accounts
+        iam.close()
 
-        # Store results
-        result.append([account_id, alias, awssso, "None"])
-        successCount = successCount + 1
+    return [[account_id, alias, awssso, "None"]], 1, 0
 
-    except ClientError as err:
-        result.append([account_id, "Unknown", "Unknown", str(err)])
-        errorCount = errorCount + 1
-
-    return result, successCount, errorCount, i
+def account_error(account_id, err):
+    """
+    Given account_id and the ClientError it failed with, returns its result, success and failure counts
+    """
+    return [[account_id, "Unknown", "Unknown", str(err)]], 0, 1
 
 def print_progress(i, n):
     """
@@ -167,18 +201,16 @@ def print_progress(i, n):
     sys.stdout.write("[%-40s] %d%%" % ('='*int(40*j), 100*j))
     sys.stdout.flush()
 
-def get_alias_and_saml_providers(session):
+def get_alias_and_saml_providers(iam):
     """
-    Given an iam client session, returns tuple of results
+    Given an iam client, returns tuple of results
 
     Args:
-        (class) boto3 Session: the boto3 session
+        (class) iam: the boto3 iam client of the account
 
     Returns:
         (tuple) tuple: alias, awssso, saml and samlinfo
     """
-    iam = session.client('iam')
-
     # Get Alias
     alias = iam.list_account_aliases()
     if 'AccountAliases' in alias:
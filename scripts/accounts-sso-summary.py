@@ -1,9 +1,17 @@
+import argparse
 import csv
 import sys
 from datetime import date
 
 import boto3
-from botocore.exceptions import ClientError
+
+from admin_detection import find_admins
+from org_snapshot import DEFAULT_SNAPSHOT_FILE, DEFAULT_SNAPSHOT_TTL_HOURS, OrgSnapshot
+from ou_crawler import crawl_ou_tree
+from credential_cache import CredentialCache, client_config
+from rate_control import get_throttle_counts, rate_controlled
+from scan_engine import DEFAULT_WORKERS, scan_accounts
+from scan_journal import ScanJournal
 
 # Fancy colouring
 class bcolors:
@@ -34,6 +42,21 @@ def write_csv(result):
     print(bcolors.HEADER + "Wrote to output file " + bcolors.UNDERLINE + outputfilename + bcolors.ENDC)
 
 def main():
+
+    parser = argparse.ArgumentParser(description="Lists admin users and SSO/SAML integrations of every account under the given OUs")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="accounts scanned at the same time (default " + str(DEFAULT_WORKERS) + ")")
+    parser.add_argument('--inline-policies', action='store_true', help="also count inline policies allowing every action on every resource")
+    parser.add_argument('--equivalent-policies', action='store_true', help="also count customer managed policies allowing every action on every resource")
+    parser.add_argument('--roles', action='store_true', help="also list admin roles, in an extra column")
+    parser.add_argument('--snapshot', default=DEFAULT_SNAPSHOT_FILE, help="file the OUs and accounts are kept in between runs (default " + DEFAULT_SNAPSHOT_FILE + ")")
+    parser.add_argument('--snapshot-ttl', type=float, default=DEFAULT_SNAPSHOT_TTL_HOURS, help="hours an OU is taken from the snapshot before being listed again (default " + str(DEFAULT_SNAPSHOT_TTL_HOURS) + ")")
+    parser.add_argument('--refresh', nargs='*', metavar='OU_ID', help="list these OUs and everything under them again, or every OU if none are given")
+    parser.add_argument('--no-snapshot', action='store_true', help="list every OU, without reading or writing the snapshot")
+    parser.add_argument('--credential-cache', metavar='FILE', help="file to keep the assumed role credentials in between runs, readable by its owner only (default: memory only)")
+    parser.add_argument('--journal', default='accounts-sso-summary.journal', help="file each account's row is recorded in as soon as it is scanned (default accounts-sso-summary.journal)")
+    parser.add_argument('--resume', action='store_true', help="keep the accounts already scanned in the journal, and only scan the others and those which failed")
+    args = parser.parse_args()
+    admin_options = { 'inline_policies': args.inline_policies, 'roles': args.roles, 'equivalent_policies': args.equivalent_policies }
         
     # Get input from the user
     start_msg = """
@@ -58,37 +81,75 @@ def main():
     parent_list = parent_raw.split()
 
     print()
-    all_ou_list = []
-
-    org = boto3.client('organizations')
-    # Get OU full list
-    for parent in parent_list:
-        print(bcolors.HEADER + "Getting OU list starting at '" + parent + "'..." + bcolors.ENDC)
-        ou_list = get_ou_list(org, parent, "")
-        ou_name = get_ou_name(org, parent)
-        ou_list.append({"Name": ou_name, "Id": parent})
-        print(bcolors.HEADER + "Will go through all accounts listed under these OUs..." + bcolors.ENDC)
-        for ou in ou_list:
-            print(bcolors.OKCYAN + ou["Name"] + bcolors.ENDC)
-        all_ou_list.extend(ou_list)
+
+    # Every client goes through a rate limiter shared by its service, which also retries throttled calls
+    org = rate_controlled(boto3.client('organizations'))
+    # Get OU full list, a level at a time, and the accounts under every OU in the same pass
+    print(bcolors.HEADER + "Getting OU list starting at '" + "', '".join(parent_list) + "'..." + bcolors.ENDC)
+    snapshot = None
+    if not args.no_snapshot:
+        snapshot = OrgSnapshot(args.snapshot, args.snapshot_ttl * 3600, args.refresh)
+    ou_tree = crawl_ou_tree(org, parent_list, with_accounts=True, workers=args.workers, snapshot=snapshot)
+    if snapshot is not None:
+        snapshot.save()
+        print(bcolors.HEADER + str(snapshot.recalled) + " OU(s) from snapshot " + bcolors.UNDERLINE + args.snapshot + bcolors.ENDC + bcolors.HEADER + ", " + str(snapshot.listed) + " listed" + bcolors.ENDC)
+    print(bcolors.HEADER + "Will go through all accounts listed under these OUs..." + bcolors.ENDC)
+    for ou in ou_tree.values():
+        print(bcolors.OKCYAN + ou["Name"] + bcolors.ENDC)
     print(bcolors.HEADER + "... and that's the end of the OU list" + bcolors.ENDC)
+
+    accounts = []
+    for ou in ou_tree.values():
+        for a in ou["Accounts"]:
+            accounts.append((ou["Name"], ou["Id"], a['Id'], a['Name']))
     
     # Prepare CSV file results
     errorCount = 0
     successCount = 0
     result = []
     result.append(['OU Name', 'OU ID', 'AccountId', 'AccountName', 'User(s)','Count of User(s)','AWS SSO', 'SAML integration', 'SAML additional info', 'Errors'])
+    if args.roles:
+        result[0].append('Admin Role(s)')
+
+    # Accounts already scanned by the run being resumed are not scanned again
+    # A journal of a scan with another role or options is not resumed from, its results would not match this one's
+    try:
+        journal = ScanJournal(args.journal, args.resume, { 'Role': role, 'Options': admin_options })
+    except ValueError as err:
+        print(bcolors.FAIL + str(err) + bcolors.ENDC)
+        return
+    pending = [account for account in accounts if account[2] not in journal.completed]
+    if args.resume:
+        print()
+        print(bcolors.HEADER + "Resuming from " + bcolors.UNDERLINE + args.journal + bcolors.ENDC + bcolors.HEADER + ", " + str(len(accounts) - len(pending)) + " account(s) already scanned, " + str(len(journal.errored)) + " failed account(s) to retry" + bcolors.ENDC)
 
     # Go through all the OUs in the list
     print()
-    print(bcolors.HEADER + "Going through all accounts under every OU in the OU list..." + bcolors.ENDC)
-
-    # Process each ou, and print out a progress bar while doing it
-    i = 0
-    n = len(all_ou_list)
-    for ou in all_ou_list:
-        ou_result, success, errors, i = process_ou(i, n, org, ou["Id"], ou["Name"], role)
-        result.extend(ou_result)
+    print(bcolors.HEADER + "Going through all " + str(len(pending)) + " accounts under every OU in the OU list, " + str(args.workers) + " at a time..." + bcolors.ENDC)
+
+    # Process the accounts side by side, and print out a progress bar while doing it
+    # One STS client for all of them, boto3 clients are thread safe but creating them is not
+    # Credentials of each account are kept until they are about to expire, its client is closed once it is scanned, see credential_cache.py
+    sts = rate_controlled(boto3.client('sts', config=client_config(args.workers)))
+    credentials = CredentialCache(sts, 'accounts-sso-summary-script', args.credential_cache, rate_controlled)
+    try:
+        scanned = scan_accounts(
+            pending,
+            lambda account: process_account(credentials, account, role, admin_options),
+            lambda account, err: account_error(account, err, admin_options),
+            args.workers,
+            print_progress,
+            # Recorded as each account finishes, so a scan which dies can be resumed with --resume
+            lambda account, scan_result: journal.record(account[2], scan_result, scan_result[2] > 0)
+        )
+    finally:
+        # Saved even if the scan dies, so running it again with --resume does not assume the roles again
+        credentials.save()
+    journal.close()
+    scanned = dict(zip([account[2] for account in pending], scanned))
+    for account in accounts:
+        row, success, errors = journal.completed[account[2]] if account[2] in journal.completed else scanned[account[2]]
+        result.append(row)
         successCount = successCount + success
         errorCount = errorCount + errors
 
@@ -98,6 +159,9 @@ def main():
     print()
     print(bcolors.OKGREEN + str(successCount) + " Successful ✔️ " + bcolors.ENDC)
     print(bcolors.FAIL + str(errorCount) + " Error(s) ❗ " + bcolors.ENDC)
+    for service_name, throttles in sorted(get_throttle_counts().items()):
+        print(bcolors.WARNING + str(throttles) + " throttled " + service_name + " call(s), slowed down and retried" + bcolors.ENDC)
+    print(bcolors.HEADER + str(credentials.assumed) + " role(s) assumed, " + str(credentials.reused) + " reused" + bcolors.ENDC)
     
     # Write the results to a CSV file
     write_csv(result)
@@ -126,77 +190,41 @@ def main():
     """
     print(bcolors.OKGREEN + done_msg + bcolors.ENDC)
 
-def process_ou(i, n, org, ou_id, ou_name, role):
+def process_account(credentials, account, role, admin_options):
     """
-    Given i, n, org, ou_id, ou_name and role, returns ou information, success, failure count, and status of progress
+    Given the CredentialCache, an (ou_name, ou_id, account_id, account_name) account, role and the find_admins options, returns the account's csv row, success and failure count.
+    Runs on a worker thread, a ClientError is turned into the account's row by account_error.
     """
-
-    # Print a nice progress bar
-    print_progress(i, n)
-    i = i + 1
-
-    # Get accounts under the OU
-    accounts = org.list_accounts_for_parent(ParentId=ou_id)
-    results = accounts['Accounts']
-
-    while "NextToken" in accounts:
-        accounts = org.list_accounts_for_parent(ParentId=ou_id,NextToken=accounts["NextToken"])
-        results.extend(accounts["Accounts"])
-
-    result = []
-    successCount = 0
-    errorCount = 0
-
-    # Go through each account in the OU
-    for a in results:
-
-        client = boto3.client('sts')
-        account_id = a['Id']
-        account_name = a['Name']
-        rolearn = 'arn:aws:iam::' + account_id + ':role/'+ role
-
-        try:
-            # Assume the role, if the role does not exist, this will simply fail
-            response = client.assume_role(RoleArn=rolearn, RoleSessionName='accounts-sso-summary-script')
-            session = boto3.Session(aws_access_key_id=response['Credentials']['AccessKeyId'],aws_secret_access_key=response['Credentials']['SecretAccessKey'],aws_session_token=response['Credentials']['SessionToken'])
-            
-            # Get users who are admin
-            adminUsers = get_admin_users(session)
-
-            # Get SAML providers
-            awssso, saml, samlinfo = get_saml_providers(session)
-
-            # Store results
-            result.append([ou_name, ou_id, account_id, account_name, list(adminUsers), len(adminUsers), awssso, saml, samlinfo, "None"])
-            # print(bcolors.OKGREEN + "Accessing account '" + account_name + "' OK" + bcolors.ENDC)
-            successCount = successCount + 1
-
-        except ClientError as err:
-            result.append([ou_name, ou_id, account_id, account_name, "Unknown", "Unknown", "Unknown", "Unknown", "Unknown", str(err)])
-            # print(bcolors.FAIL + "Unable to access account '" + account_name + "'" + bcolors.ENDC + ", Error: " + str(err))
-            errorCount = errorCount + 1
-            continue
-
-    return result, successCount, errorCount, i
-
-def get_ou_name(client, parent):
+    ou_name, ou_id, account_id, account_name = account
+
+    # Assume the role unless credentials of it are kept, if the role does not exist, this will simply fail
+    iam = credentials.client(account_id, role, 'iam')
+    try:
+        # Get users (and roles) who are admin
+        adminUsers, adminRoles = get_admin_users(iam, admin_options)
+
+        # Get SAML providers
+        awssso, saml, samlinfo = get_saml_providers(iam)
+    finally:
+        # Its connections are not needed for the other accounts
+        iam.close()
+
+    # print(bcolors.OKGREEN + "Accessing account '" + account_name + "' OK" + bcolors.ENDC)
+    row = [ou_name, ou_id, account_id, account_name, sorted(adminUsers), len(adminUsers), awssso, saml, samlinfo, "None"]
+    if admin_options['roles']:
+        row.append(sorted(adminRoles))
+    return row, 1, 0
+
+def account_error(account, err, admin_options):
     """
-    Given client and parent id, returns the name of the OU
-
-    Args:
-        (class) client: the boto3 client
-        (str) parent: OU ID, starts with 'r-' for root and 'ou-' for an OU
+    Given an (ou_name, ou_id, account_id, account_name) account, the ClientError it failed with and the find_admins options, returns the account's csv row, success and failure count
     """
-    ou_name = ""
-    if parent.startswith("r-"): # Root
-        ou_name = "Root"
-    else:
-        # Find the name
-        unit_name = client.describe_organizational_unit(
-            OrganizationalUnitId=parent
-        )
-        ou_name = unit_name["OrganizationalUnit"]["Name"]
-    return ou_name
+    ou_name, ou_id, account_id, account_name = account
+    # print(bcolors.FAIL + "Unable to access account '" + account_name + "'" + bcolors.ENDC + ", Error: " + str(err))
+    row = [ou_name, ou_id, account_id, account_name, "Unknown", "Unknown", "Unknown", "Unknown", "Unknown", str(err)]
+    if admin_options['roles']:
+        row.append("Unknown")
+    return row, 0, 1
 
 def print_progress(i, n):
     """
@@ -212,18 +240,16 @@ def print_progress(i, n):
     sys.stdout.write("[%-40s] %d%%" % ('='*int(40*j), 100*j))
     sys.stdout.flush()
 
-def get_saml_providers(session):
+def get_saml_providers(iam):
     """
-    Given an iam client session, returns tuple of results
+    Given an iam client, returns tuple of results
 
     Args:
-        (class) boto3 Session: the boto3 session
+        (class) iam: the boto3 iam client of the account
 
     Returns:
         (tuple) tuple: awssso, saml and samlinfo
     """
-    iam = session.client('iam')
-
     awssso = "No"
     saml = "No"
     samlinfo = []
@@ -239,88 +265,24 @@ def get_saml_providers(session):
 
     return awssso, saml, samlinfo
 
-def get_admin_users(session):
-    """
-    Given an iam client session, returns all admin users
-
-    Args:
-        (class) boto3 Session: the boto3 session
-
-    Returns:
-        (set) adminUsers: list of unique admin users
-    """
-    iam = session.client('iam')
-    adminUsers = set() # We only want unique users
-
-    # Get users who are admin
-    users = iam.list_users()
-    for user in users['Users']:
-        policies = iam.list_attached_user_policies(UserName=user['UserName'])
-        for policy in policies['AttachedPolicies']:
-            if policy['PolicyName'] == 'AdministratorAccess':
-                adminUsers.add("[" + user['UserName'] + "]")
-
-    # Get groups which are admin and add users who are members of the admin group
-    groups = iam.list_groups()
-    if groups['Groups']:
-        for group in groups['Groups']:
-            gpolicy = iam.list_attached_group_policies(GroupName=group['GroupName'])
-            for poli in gpolicy['AttachedPolicies']:
-                if poli['PolicyName'] == 'AdministratorAccess':
-                    us = iam.get_group(GroupName=group['GroupName'])
-                    for u in us['Users']:
-                        adminUsers.add("[" + u['UserName'] + "]")
-    
-    return adminUsers
-
-def get_ou_list(client, parent_id, prefix):
+def get_admin_users(iam, admin_options):
     """
-    Given a parent ID, this is a recursive function that returns *all* OUs as a list
-    under the parent ID.
+    Given an iam client, returns all admin users, and admin roles if asked for
 
     Args:
-        (str) parent_id: the id of the OU.
+        (class) iam: the boto3 iam client of the account
+        (dict) admin_options: inline_policies, roles and equivalent_policies, see find_admins
 
     Returns:
-        (list) result: the full list of OUs under the parent and its children.
+        (tuple) tuple: set of unique admin users and set of unique admin roles, as [name]
     """
+    # Users, groups (and roles and policies) in a few paged get_account_authorization_details calls,
+    # group membership and policies are resolved in memory
+    users, roles = find_admins(iam, **admin_options)
 
-    ou_list = []
-    olist = client.list_organizational_units_for_parent(
-        ParentId=parent_id, MaxResults=20
-    )
-
-    # See https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/organizations.html#Organizations.Client.list_organizational_units_for_parent
-    # Note:
-    # Always check the NextToken response parameter for a null value when calling a List* operation.
-    # These operations can occasionally return an empty set of results even when there are more results available.
-    # The NextToken response parameter value is null only when there are no more results to display.
-
-    if not prefix:
-        prefix = get_ou_name(client, parent_id) + " > "
-    else:
-        prefix = prefix + " > "
-    
-    while "NextToken" in olist:
-
-        for ou in olist["OrganizationalUnits"]:
-            ou_list.append({"Name": prefix + ou["Name"], "Id": ou["Id"]})
-
-        olist = client.list_organizational_units_for_parent(
-            ParentId=parent_id, MaxResults=20, NextToken=olist["NextToken"]
-        )
-
-    for ou in olist["OrganizationalUnits"]:
-        ou_list.append({"Name": prefix + ou["Name"], "Id": ou["Id"]})
-
-    if not ou_list:
-        return ou_list # Empty list
-
-    for ou in ou_list:
-        ou_list.extend(get_ou_list(client, ou["Id"], ou["Name"]))
-
-    return ou_list
-
+    adminUsers = set("[" + user + "]" for user in users)
+    adminRoles = set("[" + role + "]" for role in roles)
+    return adminUsers, adminRoles
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,93 @@
+"""
+Finds the admins of an account from get_account_authorization_details, which returns its users, groups, roles
+and policies in a few paged calls, instead of calls per user and per group. Group membership and policies are
+then resolved in memory.
+"""
+import json
+from urllib.parse import unquote
+
+# Users and groups with this managed policy attached are admins
+ADMIN_POLICY_NAME = 'AdministratorAccess'
+
+def find_admins(iam, inline_policies=False, roles=False, equivalent_policies=False):
+    """
+    Given an iam client, returns the admin users and roles of the account.
+    A user is an admin if ADMIN_POLICY_NAME is attached to it or to one of its groups.
+
+    Args:
+        (class) iam: the boto3 iam client
+        (bool) inline_policies: also count inline policies which allow every action on every resource
+        (bool) roles: also look for admin roles
+        (bool) equivalent_policies: also count customer managed policies which allow every action on every resource
+
+    Returns:
+        (tuple) tuple: set of admin user names, set of admin role names (empty unless roles)
+    """
+    filters = ['User', 'Group']
+    if roles:
+        filters.append('Role')
+    if equivalent_policies:
+        filters.append('LocalManagedPolicy')
+
+    details = { 'UserDetailList': [], 'GroupDetailList': [], 'RoleDetailList': [], 'Policies': [] }
+    for page in iam.get_paginator('get_account_authorization_details').paginate(Filter=filters):
+        for key in details:
+            details[key].extend(page.get(key, []))
+
+    # Customer managed policies as good as AdministratorAccess, by their default version
+    admin_policy_arns = set()
+    for policy in details['Policies']:
+        for version in policy.get('PolicyVersionList', []):
+            if version.get('IsDefaultVersion') and is_admin_document(version.get('Document')):
+                admin_policy_arns.add(policy['Arn'])
+
+    def grants_admin(attached, inline):
+        for policy in attached:
+            if policy['PolicyName'] == ADMIN_POLICY_NAME or policy['PolicyArn'] in admin_policy_arns:
+                return True
+        return inline_policies and any(is_admin_document(policy.get('PolicyDocument')) for policy in inline)
+
+    admin_groups = set(
+        group['GroupName'] for group in details['GroupDetailList']
+        if grants_admin(group.get('AttachedManagedPolicies', []), group.get('GroupPolicyList', []))
+    )
+    admin_users = set(
+        user['UserName'] for user in details['UserDetailList']
+        if grants_admin(user.get('AttachedManagedPolicies', []), user.get('UserPolicyList', []))
+        or admin_groups.intersection(user.get('GroupList', []))
+    )
+    admin_roles = set(
+        role['RoleName'] for role in details['RoleDetailList']
+        if grants_admin(role.get('AttachedManagedPolicies', []), role.get('RolePolicyList', []))
+    )
+    return admin_users, admin_roles
+
+def is_admin_document(document):
+    """
+    Given a policy document, returns True if a statement allows every action on every resource without conditions
+
+    Args:
+        (dict) document: the policy document, or its URL-encoded JSON text
+
+    Returns:
+        (bool) admin: whether the policy is as good as AdministratorAccess
+    """
+    if not document:
+        return False
+    if isinstance(document, str):
+        document = json.loads(unquote(document))
+
+    statements = document.get('Statement', [])
+    if isinstance(statements, dict):
+        statements = [statements]
+    for statement in statements:
+        if statement.get('Effect') != 'Allow' or 'Condition' in statement:
+            continue
+        actions = statement.get('Action', [])
+        resources = statement.get('Resource', [])
+        if '*' in as_list(actions) and '*' in as_list(resources):
+            return True
+    return False
+
+def as_list(value):
+    return value if isinstance(value, list) else [value]
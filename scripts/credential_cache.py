@@ -0,0 +1,155 @@
+"""
+Assumed role credentials and clients for the accounts-sso-*.py scripts, shared by every account they scan.
+
+One STS client assumes the roles. The credentials of each (account, role) are kept until they are about to expire,
+in memory and, if given a file, on disk (readable by its owner only) so the next runs skip STS too. The file keeps
+them by the identity which assumed them, so a run under another identity (e.g. another AWS profile) assumes its own. Clients are all
+created from one boto3 Session, which loads each service's model once instead of once per account. Clients are not
+kept: each holds its own connections, so the caller closes it once done with the account.
+"""
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from botocore.config import Config
+
+# Credentials are assumed again when they expire in less than this, so none expire in the middle of a scan
+REFRESH_MARGIN_SECONDS = 300
+ROLE_DURATION_SECONDS = 3600
+
+CACHE_VERSION = 1
+
+# Connections kept open by each account's client, which is used by one worker at a time
+ACCOUNT_POOL_CONNECTIONS = 2
+
+def client_config(max_pool_connections):
+    """
+    Given the number of threads sharing a client, returns its botocore Config
+    """
+    return Config(max_pool_connections=max(1, max_pool_connections))
+
+class CredentialCache:
+    """
+    Credentials by (account id, role), as { "AccessKeyId", "SecretAccessKey", "SessionToken", "Expiration": datetime }.
+    On disk, as { "Version": 1, "Credentials": { caller identity Arn: { "account id/role": credentials } } }.
+    """
+
+    def __init__(self, sts, session_name, path=None, wrap=None):
+        """
+        Args:
+            (class) sts: the boto3 sts client assuming every role
+            (str) session_name: RoleSessionName of the assumed roles
+            (str) path: file to keep the credentials in between runs, None to keep them in memory only
+            (function) wrap: given a new client, returns the client to use, e.g. rate_controlled
+        """
+        self.sts = sts
+        self.session_name = session_name
+        self.path = path
+        self.wrap = wrap
+        self.assumed = 0
+        self.reused = 0
+        self._credentials = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        # boto3 Sessions are not thread safe, clients created from them are
+        self._session = boto3.Session()
+        self._session_lock = threading.Lock()
+        # Credentials of the other identities in the file, written back as they were read
+        self._others = {}
+        self.identity = None
+        if path is None:
+            return
+        self.identity = sts.get_caller_identity()['Arn']
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            # Files written by another version are started again
+            if stored.get('Version') == CACHE_VERSION:
+                for identity, entries in stored['Credentials'].items():
+                    kept = self._credentials if identity == self.identity else self._others.setdefault(identity, {})
+                    for key, credentials in entries.items():
+                        credentials['Expiration'] = datetime.fromisoformat(credentials['Expiration'])
+                        kept[tuple(key.split('/', 1))] = credentials
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def is_fresh(self, credentials):
+        return credentials['Expiration'] - datetime.now(timezone.utc) > timedelta(seconds=REFRESH_MARGIN_SECONDS)
+
+    def get_credentials(self, account_id, role):
+        """
+        Given account_id and role, returns credentials of the role, assuming it only if the ones kept are about to expire.
+        Raises the ClientError of assume_role, e.g. if the role does not exist.
+        """
+        key = (account_id, role)
+        # Workers asking for the same role wait for the one assuming it
+        with self._key_lock(key):
+            credentials = self._credentials.get(key)
+            if credentials is not None and self.is_fresh(credentials):
+                with self._lock:
+                    self.reused = self.reused + 1
+                return credentials
+
+            rolearn = 'arn:aws:iam::' + account_id + ':role/' + role
+            response = self.sts.assume_role(RoleArn=rolearn, RoleSessionName=self.session_name, DurationSeconds=ROLE_DURATION_SECONDS)
+            credentials = dict((name, response['Credentials'][name]) for name in ('AccessKeyId', 'SecretAccessKey', 'SessionToken', 'Expiration'))
+            with self._lock:
+                self._credentials[key] = credentials
+                self.assumed = self.assumed + 1
+            return credentials
+
+    def client(self, account_id, role, service_name):
+        """
+        Given account_id, role and service_name, returns a new client of the service on the account, to close() once done
+
+        Args:
+            (str) account_id: AWS account id
+            (str) role: name of the role assumed on the account
+            (str) service_name: e.g. 'iam'
+
+        Returns:
+            (class) client: the boto3 client, wrapped
+        """
+        credentials = self.get_credentials(account_id, role)
+        with self._session_lock:
+            client = self._session.client(
+                service_name,
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                config=client_config(ACCOUNT_POOL_CONNECTIONS)
+            )
+        if self.wrap is not None:
+            client = self.wrap(client)
+        return client
+
+    def save(self):
+        """
+        Writes the credentials still fresh to the file, if any, readable and writable by its owner only
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            identities = dict(self._others)
+            identities[self.identity] = dict(self._credentials)
+        kept = {}
+        for identity, entries in identities.items():
+            fresh = dict(
+                ('/'.join(key), dict(credentials, Expiration=credentials['Expiration'].isoformat()))
+                for key, credentials in entries.items() if self.is_fresh(credentials)
+            )
+            if fresh:
+                kept[identity] = fresh
+        temp_path = self.path + '.tmp'
+        # Created 0600, never readable by anyone else even for a moment
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({ 'Version': CACHE_VERSION, 'Credentials': kept }, f)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, self.path)
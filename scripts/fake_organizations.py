@@ -0,0 +1,57 @@
+"""
+In-memory stand-in for the boto3 organizations client, for the test_*.py modules.
+
+Only the calls the scripts make are implemented: describe_organizational_unit and the paginators of
+list_organizational_units_for_parent and list_accounts_for_parent, one OU or account per page so paging is exercised.
+"""
+import threading
+
+class FakeOrganizations:
+    """
+    An organization of OUs and accounts, counting the calls made to it by operation name in calls
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.children = {}
+        self.accounts = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def add_ou(self, ou_id, name, parent_id=None, accounts=()):
+        """
+        Adds an OU under parent_id (the root, 'r-...', is added with its first child), with accounts as (id, name)
+        """
+        self.names[ou_id] = name
+        self.children.setdefault(ou_id, [])
+        self.accounts[ou_id] = [{ 'Id': account_id, 'Name': account_name } for account_id, account_name in accounts]
+        if parent_id is not None:
+            self.children.setdefault(parent_id, []).append(ou_id)
+            self.accounts.setdefault(parent_id, [])
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def describe_organizational_unit(self, OrganizationalUnitId):
+        self._count('describe_organizational_unit')
+        return { 'OrganizationalUnit': { 'Id': OrganizationalUnitId, 'Name': self.names[OrganizationalUnitId] } }
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(self, operation_name)
+
+class FakePaginator:
+
+    def __init__(self, org, operation_name):
+        self.org = org
+        self.operation_name = operation_name
+
+    def paginate(self, ParentId):
+        if self.operation_name == 'list_organizational_units_for_parent':
+            key, items = 'OrganizationalUnits', [{ 'Id': ou_id, 'Name': self.org.names[ou_id] } for ou_id in self.org.children[ParentId]]
+        else:
+            key, items = 'Accounts', [dict(account) for account in self.org.accounts[ParentId]]
+        # Empty pages come back as a single page with nothing in it
+        for start in range(0, max(1, len(items))):
+            self.org._count(self.operation_name)
+            yield { key: items[start:start + 1] }
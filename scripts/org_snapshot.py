@@ -0,0 +1,105 @@
+"""
+On-disk snapshot of the organization for the accounts-sso-*.py scripts: every OU listed, with its name, child OUs,
+accounts and when it was listed, kept in a compact JSON file between runs.
+
+An OU listed less than ttl seconds ago is taken from the snapshot instead of Organizations. Only the OUs which are
+older, or which are asked to be refreshed along with everything under them, are listed again, so a run against an
+organization which hardly changes goes straight to scanning accounts.
+"""
+import json
+import os
+import time
+
+SNAPSHOT_VERSION = 1
+DEFAULT_SNAPSHOT_FILE = 'org-snapshot.json'
+DEFAULT_SNAPSHOT_TTL_HOURS = 24
+
+class OrgSnapshot:
+    """
+    OUs by id, as { "Name": own name, "Children": [child ids], "Accounts": [{"Id", "Name"}], "Listed": epoch seconds }
+    """
+
+    def __init__(self, path, ttl, refresh_ids=None):
+        """
+        Args:
+            (str) path: the snapshot file, read if it exists
+            (int) ttl: seconds an OU is used for before being listed again
+            (list) refresh_ids: OU IDs to list again now, with every OU under them, an empty list for all of them
+        """
+        self.path = path
+        self.ttl = ttl
+        self.ous = {}
+        self.recalled = 0
+        self.listed = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                snapshot = json.load(f)
+            # Snapshots written by another version are listed again from scratch
+            if snapshot.get('Version') == SNAPSHOT_VERSION:
+                self.ous = snapshot['OrganizationalUnits']
+        if refresh_ids is None:
+            self.stale = set()
+        elif not refresh_ids:
+            self.stale = set(self.ous)
+        else:
+            self.stale = self._subtrees(refresh_ids)
+
+    def _subtrees(self, ou_ids):
+        """
+        Given OU ids, returns them and the ids of every OU under them in the snapshot
+        """
+        found = set()
+        level = list(ou_ids)
+        while level:
+            found.update(level)
+            level = [child for ou_id in level if ou_id in self.ous for child in self.ous[ou_id]['Children'] if child not in found]
+        return found
+
+    def is_fresh(self, ou_id):
+        ou = self.ous.get(ou_id)
+        return ou is not None and ou_id not in self.stale and time.time() - ou['Listed'] < self.ttl
+
+    def get_name(self, ou_id):
+        """
+        Returns the OU's own name if it is fresh, or None for an OU to describe again: missing, stale or to be refreshed
+        """
+        if not self.is_fresh(ou_id):
+            return None
+        return self.ous[ou_id]['Name']
+
+    def get_children(self, ou_id):
+        """
+        Given a fresh OU, returns its child OUs and accounts as list_children would, and False as it was not listed.
+        Returns None for an OU to list again: stale, to be refreshed, or with a child OU missing from the snapshot.
+        """
+        if not self.is_fresh(ou_id):
+            return None
+        ou = self.ous[ou_id]
+        if any(child not in self.ous for child in ou['Children']):
+            return None
+        self.recalled = self.recalled + 1
+        children = [{ 'Id': child, 'Name': self.ous[child]['Name'] } for child in ou['Children']]
+        return children, list(ou['Accounts']), False
+
+    def put(self, ou_id, name, children, accounts):
+        """
+        Records an OU just listed, and the names of its child OUs
+        """
+        self.listed = self.listed + 1
+        self.stale.discard(ou_id)
+        for child in children:
+            if child['Id'] in self.ous:
+                self.ous[child['Id']]['Name'] = child['Name']
+            else:
+                # Listed when the walk gets to it, until then it is stale
+                self.ous[child['Id']] = { 'Name': child['Name'], 'Children': [], 'Accounts': [], 'Listed': 0 }
+        self.ous[ou_id] = { 'Name': name, 'Children': [child['Id'] for child in children], 'Accounts': accounts, 'Listed': time.time() }
+
+    def save(self):
+        """
+        Writes the snapshot, to a temporary file first so an interrupted run leaves the previous snapshot whole
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({ 'Version': SNAPSHOT_VERSION, 'OrganizationalUnits': self.ous }, f, separators=(',', ':'))
+        os.replace(temp_path, self.path)
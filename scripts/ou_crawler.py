@@ -0,0 +1,119 @@
+"""
+Walks the OU tree under the given OUs breadth first, for the accounts-sso-*.py scripts.
+
+All the OUs of a level are listed side by side, through paginators. The name of an OU is its parent's name and its
+own, joined by ' > ', so apart from the OUs the walk starts at no OU is described. Each OU is visited once, however
+many of the starting OUs it is found under, and its accounts can be listed in the same pass. OUs listed recently
+enough can be taken from a snapshot instead, see org_snapshot.py.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from scan_engine import DEFAULT_WORKERS
+
+def crawl_ou_tree(org, parent_ids, with_accounts=False, workers=DEFAULT_WORKERS, snapshot=None):
+    """
+    Given org and OU ids, returns the tree of OUs under them, starting OUs included.
+
+    Each OU is a dict of:
+        Id: OU id
+        Name: the OU's path from the starting OU it was found under, e.g. 'Root > Workloads > Prod'
+        ParentId: the parent OU's id, None for a starting OU
+        Children: ids of the child OUs
+        Accounts: the accounts directly under the OU, as {"Id", "Name"} dicts, only with_accounts
+
+    Args:
+        (class) org: the boto3 organizations client
+        (list) parent_ids: OU IDs to start at, starting with 'r-' for root and 'ou-' for an OU
+        (bool) with_accounts: also list the accounts of every OU
+        (int) workers: the most OUs listed at the same time
+        (class) snapshot: OrgSnapshot to take fresh OUs from and record listed OUs in, needs with_accounts
+
+    Returns:
+        (dict) tree: the OUs by id, level by level, in the order they were found
+    """
+    tree = {}
+    # The OUs' own names, their Name being the whole path
+    own_names = {}
+    level = []
+    for parent_id in parent_ids:
+        if parent_id not in tree:
+            tree[parent_id] = { 'Id': parent_id, 'Name': None, 'ParentId': None, 'Children': [] }
+            level.append(parent_id)
+
+    def describe(ou_id):
+        # Only fresh OUs are named from the snapshot, any other is described and listed again, which records its name
+        name = snapshot.get_name(ou_id) if snapshot is not None else None
+        return name if name is not None else get_ou_name(org, ou_id)
+
+    def list_or_recall(ou_id):
+        recalled = snapshot.get_children(ou_id) if snapshot is not None else None
+        return recalled if recalled is not None else list_children(org, ou_id, with_accounts) + (True,)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for ou_id, name in zip(level, executor.map(describe, level)):
+            tree[ou_id]['Name'] = name
+            own_names[ou_id] = name
+
+        while level:
+            next_level = []
+            for ou_id, (children, accounts, listed) in zip(level, executor.map(list_or_recall, level)):
+                node = tree[ou_id]
+                if with_accounts:
+                    node['Accounts'] = accounts
+                if listed and snapshot is not None:
+                    snapshot.put(ou_id, own_names[ou_id], children, accounts)
+                for child in children:
+                    # Already found under another starting OU
+                    if child['Id'] in tree:
+                        continue
+                    tree[child['Id']] = { 'Id': child['Id'], 'Name': node['Name'] + " > " + child['Name'], 'ParentId': ou_id, 'Children': [] }
+                    own_names[child['Id']] = child['Name']
+                    node['Children'].append(child['Id'])
+                    next_level.append(child['Id'])
+            level = next_level
+
+    return tree
+
+def list_children(org, ou_id, with_accounts=False):
+    """
+    Given org and ou_id, returns the OUs directly under the OU, and its accounts if asked for
+
+    Args:
+        (class) org: the boto3 organizations client
+        (str) ou_id: OU ID
+        (bool) with_accounts: also list the accounts of the OU
+
+    Returns:
+        (tuple) tuple: the child OUs and the accounts (None unless with_accounts), as {"Id", "Name"} dicts
+    """
+    # Paginators follow NextToken until it is null, which List* operations need as they can return an empty page before the last one
+    children = []
+    for page in org.get_paginator('list_organizational_units_for_parent').paginate(ParentId=ou_id):
+        children.extend({ 'Id': ou['Id'], 'Name': ou['Name'] } for ou in page['OrganizationalUnits'])
+
+    accounts = None
+    if with_accounts:
+        accounts = []
+        for page in org.get_paginator('list_accounts_for_parent').paginate(ParentId=ou_id):
+            accounts.extend({ 'Id': account['Id'], 'Name': account['Name'] } for account in page['Accounts'])
+
+    return children, accounts
+
+def get_ou_name(client, parent):
+    """
+    Given client and parent id, returns the name of the OU
+
+    Args:
+        (class) client: the boto3 client
+        (str) parent: OU ID, starts with 'r-' for root and 'ou-' for an OU
+    """
+    ou_name = ""
+    if parent.startswith("r-"): # Root
+        ou_name = "Root"
+    else:
+        # Find the name
+        unit_name = client.describe_organizational_unit(
+            OrganizationalUnitId=parent
+        )
+        ou_name = unit_name["OrganizationalUnit"]["Name"]
+    return ou_name
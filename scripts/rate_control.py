@@ -0,0 +1,144 @@
+"""
+Client side rate control for the AWS calls of the accounts-sso-*.py scripts, shared by every client of a service.
+
+Every request first takes a token from its service's bucket. The bucket's rate goes up a little with every
+success and is halved on every throttling error (additive increase, multiplicative decrease), so the scan settles
+just under the rate AWS allows. Throttling errors, and only those, are retried after a decorrelated jitter delay.
+"""
+import random
+import threading
+import time
+
+# Requests per second each service starts at, and the most it is allowed to climb to
+SERVICE_RATES = {
+    'organizations': (4.0, 16.0),
+    'sts': (20.0, 80.0),
+    'iam': (10.0, 40.0)
+}
+DEFAULT_RATE = (10.0, 40.0)
+
+# Error codes AWS uses when a caller is going too fast
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'SlowDown'
+)
+
+# Retries of a throttled request, and the bounds in seconds of the delay between them
+MAX_THROTTLE_ATTEMPTS = 10
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20.0
+
+class AdaptiveTokenBucket:
+    """
+    Hands out tokens at rate per second, allowing bursts of up to one second's worth.
+    The rate rises by increase requests per second for every second's worth of successful requests,
+    and is multiplied by decrease on every throttling error, within [min_rate, max_rate].
+    """
+
+    def __init__(self, rate, max_rate, min_rate=0.5, increase=1.0, decrease=0.5):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.throttles = 0
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens = self._tokens - 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.throttles = self.throttles + 1
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_bucket(service_name):
+    """
+    Given a service name, returns the token bucket shared by every client of that service
+    """
+    with _buckets_lock:
+        if service_name not in _buckets:
+            rate, max_rate = SERVICE_RATES.get(service_name, DEFAULT_RATE)
+            _buckets[service_name] = AdaptiveTokenBucket(rate, max_rate)
+        return _buckets[service_name]
+
+def get_throttle_counts():
+    """
+    Returns the number of throttling errors seen so far, by service
+    """
+    with _buckets_lock:
+        return { service_name: bucket.throttles for service_name, bucket in _buckets.items() if bucket.throttles }
+
+def get_retry_delay(previous_delay):
+    """
+    Given the previous delay, returns the next decorrelated jitter delay
+    see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    """
+    return min(RETRY_MAX_DELAY, random.uniform(RETRY_BASE_DELAY, previous_delay * 3))
+
+def rate_controlled(client):
+    """
+    Given a boto3 client, makes every request it sends, paginators included, go through its service's
+    token bucket and retries its throttling errors, and returns it
+
+    Args:
+        (class) client: the boto3 client
+
+    Returns:
+        (class) client: the same client
+    """
+    bucket = get_bucket(client.meta.service_model.service_name)
+
+    def before_send(**kwargs):
+        bucket.acquire()
+
+    def needs_retry(response=None, attempts=None, request_dict=None, **kwargs):
+        # No response is a connection error, left to botocore's own retries
+        if response is None:
+            return None
+        http_response, parsed = response
+        code = parsed.get('Error', {}).get('Code') if isinstance(parsed, dict) else None
+        if code not in THROTTLING_ERROR_CODES:
+            if http_response.status_code < 400:
+                bucket.on_success()
+            return None
+
+        bucket.on_throttle()
+        if attempts >= MAX_THROTTLE_ATTEMPTS:
+            return None
+        # The delay of the previous retry is kept with the request, which is the same object on every attempt
+        context = request_dict['context']
+        delay = get_retry_delay(context.get('throttle_retry_delay', RETRY_BASE_DELAY))
+        context['throttle_retry_delay'] = delay
+        return delay
+
+    # Registered on the same event as botocore's retry handler, ahead of it, which only gets to answer when we return None
+    client.meta.events.register('before-send', before_send)
+    client.meta.events.register_first('needs-retry.' + client.meta.service_model.service_id.hyphenize(), needs_retry)
+    return client
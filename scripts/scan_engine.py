@@ -0,0 +1,56 @@
+"""
+Bounded worker pool which scans accounts side by side, shared by the accounts-sso-*.py scripts.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from botocore.exceptions import ClientError
+
+DEFAULT_WORKERS = 8
+
+def scan_accounts(items, scan_item, on_error, workers=DEFAULT_WORKERS, progress=None, on_result=None):
+    """
+    Given work items (e.g. accounts), runs scan_item on each of them on up to workers threads at a time,
+    so the scan takes about (items / workers) x the time of one item instead of the sum of them.
+
+    A ClientError raised by scan_item only fails its own item, which is then passed to on_error instead.
+
+    Args:
+        (list) items: the work items, one per account
+        (function) scan_item: given an item, returns its result
+        (function) on_error: given an item and the ClientError it raised, returns its result
+        (int) workers: the most items scanned at the same time
+        (function) progress: given the number of items done (less one) and the number of items, prints progress
+        (function) on_result: given an item and its result, called as soon as the item is done, e.g. to record it
+
+    Returns:
+        (list) results: the result of each item, in the order of items however the items finish
+    """
+    results = [None] * len(items)
+
+    def run(index):
+        try:
+            return scan_item(items[index])
+        except ClientError as err:
+            return on_error(items[index], err)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    futures = { executor.submit(run, index): index for index in range(len(items)) }
+    try:
+        done = 0
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if on_result is not None:
+                on_result(items[futures[future]], results[futures[future]])
+            done = done + 1
+            if progress is not None:
+                progress(done - 1, len(items))
+    except BaseException:
+        # On Ctrl-C or an unexpected error, the accounts not started yet are dropped instead of all being scanned
+        # before exiting, only those already running are waited for (cancel_futures needs Python 3.9)
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+
+    return results
@@ -0,0 +1,79 @@
+"""
+Checkpoint journal of the accounts-sso-*.py scripts: one JSON line per account, written as soon as the account is
+scanned, so a scan which dies half way can be resumed instead of run again from the start.
+
+A resumed scan keeps the results of the accounts already scanned and only scans the others, those which failed
+included. The journal is appended to, the last line of an account being the one which counts. Its first line holds
+the role and options of the scan, and a scan with other ones (e.g. more csv columns) refuses to resume from it.
+"""
+import json
+import os
+
+class ScanJournal:
+    """
+    A { "Header": the role and options of the scan } line, then lines of
+    { "AccountId", "Status": "done" or "error", "Result": the account's result }
+    """
+
+    def __init__(self, path, resume=False, header=None):
+        """
+        Args:
+            (str) path: the journal file
+            (bool) resume: keep the accounts done in the journal, otherwise the journal is started again
+            (dict) header: the role and options of the scan, which the journal must have been written with to resume
+
+        Raises:
+            ValueError: resuming from a journal written with another header
+        """
+        self.path = path
+        self.header = header if header is not None else {}
+        self.completed = {}
+        self.errored = set()
+        resume = resume and os.path.exists(path) and os.path.getsize(path) > 0
+        if resume:
+            with open(path) as f:
+                found = None
+                for number, line in enumerate(f):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a scan killed while writing it
+                        continue
+                    if number == 0:
+                        found = entry.get('Header')
+                        if found is not None:
+                            continue
+                    if entry['Status'] == 'done':
+                        self.completed[entry['AccountId']] = entry['Result']
+                        self.errored.discard(entry['AccountId'])
+                    else:
+                        self.completed.pop(entry['AccountId'], None)
+                        self.errored.add(entry['AccountId'])
+            # Compared as read back from JSON, e.g. tuples become lists
+            if found != json.loads(json.dumps(self.header)):
+                raise ValueError("Journal " + path + " was written by a scan with " + json.dumps(found) + ", not " + json.dumps(self.header) + ", run without --resume to start again")
+
+        self._file = open(path, 'a' if resume else 'w')
+        if not resume:
+            self._file.write(json.dumps({ 'Header': self.header }) + '\n')
+            self._file.flush()
+        elif not self._ends_with_newline():
+            # The last line of a scan killed while writing it, the next entry starts a line of its own
+            self._file.write('\n')
+            self._file.flush()
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def record(self, account_id, result, failed):
+        """
+        Given an account id, its result and whether it failed, adds it to the journal and flushes it
+        """
+        entry = { 'AccountId': account_id, 'Status': 'error' if failed else 'done', 'Result': result }
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
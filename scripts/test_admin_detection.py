@@ -0,0 +1,76 @@
+"""
+Tests of admin_detection.py, against a fake IAM client.
+
+    $ python -m unittest discover scripts
+"""
+import unittest
+from urllib.parse import quote
+
+from admin_detection import find_admins, is_admin_document
+
+ADMIN_POLICY = { 'PolicyName': 'AdministratorAccess', 'PolicyArn': 'arn:aws:iam::aws:policy/AdministratorAccess' }
+ALLOW_ALL = { 'Statement': [{ 'Effect': 'Allow', 'Action': '*', 'Resource': '*' }] }
+
+class FakeIam:
+    """
+    Answers get_account_authorization_details in two pages, keeping only the lists asked for by Filter
+    """
+
+    def __init__(self):
+        self.filters = []
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Filter):
+        self.filters.append(Filter)
+        users = [
+            { 'UserName': 'direct', 'GroupList': [], 'AttachedManagedPolicies': [ADMIN_POLICY], 'UserPolicyList': [] },
+            { 'UserName': 'member', 'GroupList': ['admins'], 'AttachedManagedPolicies': [], 'UserPolicyList': [] },
+            # Inline policies come URL-encoded
+            { 'UserName': 'inline', 'GroupList': ['dev'], 'AttachedManagedPolicies': [], 'UserPolicyList': [{ 'PolicyName': 'all', 'PolicyDocument': quote('{"Statement": [{"Effect": "Allow", "Action": "*", "Resource": "*"}]}') }] },
+            { 'UserName': 'equivalent', 'GroupList': [], 'AttachedManagedPolicies': [{ 'PolicyName': 'God', 'PolicyArn': 'arn:aws:iam::1:policy/God' }], 'UserPolicyList': [] },
+            { 'UserName': 'developer', 'GroupList': ['dev'], 'AttachedManagedPolicies': [], 'UserPolicyList': [] },
+        ]
+        pages = [
+            { 'UserDetailList': users[:2], 'GroupDetailList': [
+                { 'GroupName': 'admins', 'AttachedManagedPolicies': [ADMIN_POLICY], 'GroupPolicyList': [] },
+                { 'GroupName': 'dev', 'AttachedManagedPolicies': [], 'GroupPolicyList': [] },
+            ] },
+            { 'UserDetailList': users[2:] },
+        ]
+        if 'Role' in Filter:
+            pages[1]['RoleDetailList'] = [
+                { 'RoleName': 'OrgAdmin', 'AttachedManagedPolicies': [ADMIN_POLICY], 'RolePolicyList': [] },
+                { 'RoleName': 'ReadOnly', 'AttachedManagedPolicies': [], 'RolePolicyList': [] },
+            ]
+        if 'LocalManagedPolicy' in Filter:
+            pages[1]['Policies'] = [{ 'Arn': 'arn:aws:iam::1:policy/God', 'PolicyVersionList': [
+                { 'IsDefaultVersion': False, 'Document': { 'Statement': [] } },
+                { 'IsDefaultVersion': True, 'Document': ALLOW_ALL },
+            ] }]
+        return iter(pages)
+
+class FindAdminsTest(unittest.TestCase):
+
+    def test_attached_policy_directly_or_through_a_group(self):
+        iam = FakeIam()
+        self.assertEqual(find_admins(iam), ({ 'direct', 'member' }, set()))
+        self.assertEqual(iam.filters, [['User', 'Group']])
+
+    def test_wider_searches(self):
+        iam = FakeIam()
+        admins = find_admins(iam, inline_policies=True, roles=True, equivalent_policies=True)
+        self.assertEqual(admins, ({ 'direct', 'member', 'inline', 'equivalent' }, { 'OrgAdmin' }))
+        self.assertEqual(iam.filters, [['User', 'Group', 'Role', 'LocalManagedPolicy']])
+
+    def test_admin_documents(self):
+        self.assertTrue(is_admin_document(ALLOW_ALL))
+        self.assertTrue(is_admin_document({ 'Statement': { 'Effect': 'Allow', 'Action': ['s3:*', '*'], 'Resource': ['*'] } }))
+        self.assertFalse(is_admin_document(None))
+        self.assertFalse(is_admin_document({ 'Statement': [{ 'Effect': 'Deny', 'Action': '*', 'Resource': '*' }] }))
+        self.assertFalse(is_admin_document({ 'Statement': [{ 'Effect': 'Allow', 'Action': '*', 'Resource': 'arn:aws:s3:::bucket' }] }))
+        self.assertFalse(is_admin_document({ 'Statement': [{ 'Effect': 'Allow', 'Action': '*', 'Resource': '*', 'Condition': { 'Bool': { 'aws:MultiFactorAuthPresent': 'true' } } }] }))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests of credential_cache.py, against a fake STS client.
+
+    $ python -m unittest discover scripts
+"""
+import os
+import stat
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from credential_cache import CredentialCache, REFRESH_MARGIN_SECONDS
+
+class FakeSts:
+    """
+    Assumes any role as the given identity, handing out new keys each time
+    """
+
+    def __init__(self, identity, lifetime=3600):
+        self.identity = identity
+        self.lifetime = lifetime
+        self.assumed = []
+
+    def get_caller_identity(self):
+        return { 'Arn': self.identity }
+
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds):
+        self.assumed.append(RoleArn)
+        return { 'Credentials': {
+            'AccessKeyId': 'AK' + str(len(self.assumed)),
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': datetime.now(timezone.utc) + timedelta(seconds=self.lifetime)
+        } }
+
+class CredentialCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'creds.json')
+
+    def run_scan(self, sts, accounts):
+        """
+        Gets credentials of every account through a cache on the file, as a run of a script, and saves them
+        """
+        cache = CredentialCache(sts, 'test', self.path)
+        for account_id in accounts:
+            cache.get_credentials(account_id, 'Audit')
+        cache.save()
+        return cache
+
+    def test_reused_by_the_same_identity_only(self):
+        alice = FakeSts('arn:aws:sts::123456789012:assumed-role/Alice/alice')
+        bob = FakeSts('arn:aws:sts::123456789012:assumed-role/Bob/bob')
+        self.run_scan(alice, ['111111111111', '222222222222'])
+        self.assertEqual(len(alice.assumed), 2)
+
+        # Another profile does not get alice's credentials
+        cache = self.run_scan(bob, ['111111111111'])
+        self.assertEqual((len(bob.assumed), cache.reused), (1, 0))
+
+        # And saving bob's keeps alice's
+        cache = self.run_scan(alice, ['111111111111', '222222222222'])
+        self.assertEqual((len(alice.assumed), cache.reused), (2, 2))
+
+    def test_expiring_credentials_are_assumed_again(self):
+        sts = FakeSts('arn:aws:iam::123456789012:user/alice', lifetime=REFRESH_MARGIN_SECONDS - 1)
+        self.run_scan(sts, ['111111111111'])
+        cache = self.run_scan(sts, ['111111111111'])
+        self.assertEqual((len(sts.assumed), cache.reused), (2, 0))
+
+    def test_file_is_private_and_other_versions_are_ignored(self):
+        sts = FakeSts('arn:aws:iam::123456789012:user/alice')
+        with open(self.path, 'w') as f:
+            f.write('{"111111111111/Audit": {"AccessKeyId": "old"}}')
+        self.run_scan(sts, ['111111111111'])
+        self.assertEqual(len(sts.assumed), 1)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Tests of org_snapshot.py, through crawl_ou_tree against fake_organizations.py.
+
+    $ python -m unittest discover scripts
+"""
+import os
+import tempfile
+import unittest
+
+from fake_organizations import FakeOrganizations
+from org_snapshot import OrgSnapshot
+from ou_crawler import crawl_ou_tree
+
+class OrgSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.org = FakeOrganizations()
+        self.org.add_ou('ou-a', 'Workloads')
+        self.org.add_ou('ou-a1', 'Prod', 'ou-a', [('111111111111', 'prod-1'), ('111111111112', 'prod-2')])
+        self.org.add_ou('ou-a2', 'Dev', 'ou-a', [('222222222221', 'dev-1')])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'org-snapshot.json')
+
+    def crawl(self, ttl=3600, refresh_ids=None):
+        """
+        Crawls from ou-a with a snapshot read from and saved to the file, returns the OU names by id and the calls made
+        """
+        self.org.calls = {}
+        snapshot = OrgSnapshot(self.path, ttl, refresh_ids)
+        tree = crawl_ou_tree(self.org, ['ou-a'], with_accounts=True, snapshot=snapshot)
+        snapshot.save()
+        return { ou_id: ou['Name'] for ou_id, ou in tree.items() }, self.org.calls
+
+    def test_fresh_snapshot_makes_no_calls(self):
+        first, calls = self.crawl()
+        self.assertEqual(first, { 'ou-a': 'Workloads', 'ou-a1': 'Workloads > Prod', 'ou-a2': 'Workloads > Dev' })
+        self.assertEqual(calls['describe_organizational_unit'], 1)
+
+        second, calls = self.crawl()
+        self.assertEqual(second, first)
+        self.assertEqual(calls, {})
+
+    def test_stale_starting_ou_is_described_again(self):
+        self.crawl()
+        for ttl, refresh_ids in ((0, None), (3600, ['ou-a']), (3600, [])):
+            with self.subTest(ttl=ttl, refresh_ids=refresh_ids):
+                self.org.names['ou-a'] = self.org.names['ou-a'] + '!'
+                names, calls = self.crawl(ttl, refresh_ids)
+                self.assertEqual(names['ou-a1'], self.org.names['ou-a'] + ' > Prod')
+                self.assertEqual(calls['describe_organizational_unit'], 1)
+                # The new name was recorded, the next run within the ttl takes it from the snapshot
+                names, calls = self.crawl()
+                self.assertEqual(names['ou-a'], self.org.names['ou-a'])
+                self.assertEqual(calls, {})
+
+    def test_refresh_lists_the_subtree_only(self):
+        self.crawl()
+        self.org.add_ou('ou-a3', 'Test', 'ou-a1')
+        names, calls = self.crawl(refresh_ids=['ou-a1'])
+        self.assertEqual(names['ou-a3'], 'Workloads > Prod > Test')
+        # ou-a1 and the new ou-a3 are listed, ou-a and ou-a2 are taken from the snapshot
+        self.assertNotIn('describe_organizational_unit', calls)
+        self.assertEqual(calls['list_organizational_units_for_parent'], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+"""
+Tests of ou_crawler.py, against fake_organizations.py.
+
+    $ python -m unittest discover scripts
+"""
+import unittest
+
+from fake_organizations import FakeOrganizations
+from ou_crawler import crawl_ou_tree
+
+class CrawlOuTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.org = FakeOrganizations()
+        self.org.add_ou('ou-a', 'Workloads', 'r-1', [('111111111111', 'shared')])
+        self.org.add_ou('ou-a1', 'Prod', 'ou-a', [('222222222221', 'prod-1'), ('222222222222', 'prod-2')])
+        self.org.add_ou('ou-a2', 'Dev', 'ou-a')
+        self.org.add_ou('ou-b', 'Sandbox', 'r-1', [('333333333331', 'sandbox-1')])
+
+    def test_names_are_paths_from_the_starting_ou(self):
+        tree = crawl_ou_tree(self.org, ['r-1'], with_accounts=True, workers=4)
+        self.assertEqual(list(tree), ['r-1', 'ou-a', 'ou-b', 'ou-a1', 'ou-a2'])
+        self.assertEqual(tree['ou-a1']['Name'], 'Root > Workloads > Prod')
+        self.assertEqual(tree['ou-a1']['ParentId'], 'ou-a')
+        self.assertEqual(tree['ou-a']['Children'], ['ou-a1', 'ou-a2'])
+        self.assertEqual([account['Id'] for account in tree['ou-a1']['Accounts']], ['222222222221', '222222222222'])
+        self.assertEqual(tree['ou-a2']['Accounts'], [])
+        # The root is not described, and no other OU is either
+        self.assertNotIn('describe_organizational_unit', self.org.calls)
+
+    def test_ous_under_several_starting_ous_are_visited_once(self):
+        tree = crawl_ou_tree(self.org, ['ou-a1', 'ou-a', 'ou-a'], workers=2)
+        self.assertEqual(sorted(tree), ['ou-a', 'ou-a1', 'ou-a2'])
+        # ou-a1 keeps the name it started with, and is not a child of ou-a in this tree
+        self.assertEqual(tree['ou-a1']['Name'], 'Prod')
+        self.assertEqual(tree['ou-a']['Children'], ['ou-a2'])
+        self.assertEqual(self.org.calls['describe_organizational_unit'], 2)
+        # ou-a1 lists its one page (no children), ou-a two pages (two children) and ou-a2 one
+        self.assertEqual(self.org.calls['list_organizational_units_for_parent'], 4)
+        self.assertNotIn('list_accounts_for_parent', self.org.calls)
+
+if __name__ == "__main__":
+    unittest.main()
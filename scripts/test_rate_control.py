@@ -0,0 +1,97 @@
+"""
+Tests of rate_control.py, with a botocore client answered by a fake HTTP layer instead of AWS.
+
+    $ python -m unittest discover scripts
+"""
+import time
+import unittest
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.config import Config
+
+import rate_control
+from rate_control import AdaptiveTokenBucket, rate_controlled
+
+THROTTLED = b'<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code><Message>Rate exceeded</Message></Error><RequestId>1</RequestId></ErrorResponse>'
+DENIED = b'<ErrorResponse><Error><Type>Sender</Type><Code>AccessDenied</Code><Message>Denied</Message></Error><RequestId>1</RequestId></ErrorResponse>'
+IDENTITY = (
+    b'<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/"><GetCallerIdentityResult>'
+    b'<Arn>arn:aws:iam::123456789012:user/alice</Arn><UserId>AIDA</UserId><Account>123456789012</Account>'
+    b'</GetCallerIdentityResult><ResponseMetadata><RequestId>1</RequestId></ResponseMetadata></GetCallerIdentityResponse>'
+)
+
+class RawBody:
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+class AdaptiveTokenBucketTest(unittest.TestCase):
+
+    def test_rate_follows_successes_and_throttles(self):
+        bucket = AdaptiveTokenBucket(4.0, 5.0, min_rate=1.0)
+        bucket.on_throttle()
+        self.assertEqual((bucket.rate, bucket.throttles), (2.0, 1))
+        bucket.on_throttle()
+        bucket.on_throttle()
+        self.assertEqual(bucket.rate, 1.0)
+        for _ in range(100):
+            bucket.on_success()
+        self.assertEqual(bucket.rate, 5.0)
+
+    def test_acquire_keeps_to_the_rate(self):
+        bucket = AdaptiveTokenBucket(50.0, 50.0)
+        started = time.monotonic()
+        for _ in range(11):
+            bucket.acquire()
+        # One token to start with, then 10 at 50 a second
+        self.assertGreaterEqual(time.monotonic() - started, 0.18)
+
+    def test_retry_delay_stays_in_bounds(self):
+        # The first retry starts from RETRY_BASE_DELAY
+        for previous in (rate_control.RETRY_BASE_DELAY, 1.0, 100.0):
+            delay = rate_control.get_retry_delay(previous)
+            self.assertTrue(rate_control.RETRY_BASE_DELAY <= delay <= rate_control.RETRY_MAX_DELAY)
+
+class RateControlledTest(unittest.TestCase):
+
+    def setUp(self):
+        rate_control._buckets.clear()
+        self.addCleanup(rate_control._buckets.clear)
+        self.sent = []
+        self.responses = []
+        # No botocore retries, so any retry is rate_controlled's
+        self.client = boto3.client('sts', region_name='us-east-1', aws_access_key_id='AK', aws_secret_access_key='secret',
+                                   config=Config(retries={ 'mode': 'standard', 'max_attempts': 1 }))
+        rate_controlled(self.client)
+        # Registered last, after the rate limiter has let the request through, it answers instead of AWS
+        self.client.meta.events.register_last('before-send', self.answer)
+
+    def answer(self, request, **kwargs):
+        status, body = self.responses.pop(0)
+        self.sent.append(request.url)
+        return AWSResponse(request.url, status, {}, RawBody(body))
+
+    def test_throttled_calls_are_retried(self):
+        delays = iter([0.001, 0.002])
+        original = rate_control.get_retry_delay
+        rate_control.get_retry_delay = lambda previous: next(delays)
+        self.addCleanup(setattr, rate_control, 'get_retry_delay', original)
+
+        self.responses = [(400, THROTTLED), (400, THROTTLED), (200, IDENTITY)]
+        self.assertEqual(self.client.get_caller_identity()['Account'], '123456789012')
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(rate_control.get_throttle_counts(), { 'sts': 2 })
+
+    def test_other_errors_are_not_retried(self):
+        self.responses = [(403, DENIED)]
+        with self.assertRaises(self.client.exceptions.ClientError):
+            self.client.get_caller_identity()
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(rate_control.get_throttle_counts(), {})
+
+if __name__ == "__main__":
+    unittest.main()
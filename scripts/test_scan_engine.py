@@ -0,0 +1,65 @@
+"""
+Tests of scan_engine.py.
+
+    $ python -m unittest discover scripts
+"""
+import threading
+import time
+import unittest
+
+from botocore.exceptions import ClientError
+
+from scan_engine import scan_accounts
+
+class ScanAccountsTest(unittest.TestCase):
+
+    def test_results_in_item_order_with_bounded_workers(self):
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def scan_item(item):
+            with lock:
+                running.append(item)
+                most.append(len(running))
+            # Later items finish first
+            time.sleep(0.001 * (10 - item))
+            with lock:
+                running.remove(item)
+            return item * 2
+
+        recorded = []
+        progress = []
+        results = scan_accounts(list(range(10)), scan_item, None, 3, lambda done, total: progress.append((done, total)), lambda item, result: recorded.append(item))
+        self.assertEqual(results, [item * 2 for item in range(10)])
+        self.assertEqual(max(most), 3)
+        self.assertEqual(sorted(recorded), list(range(10)))
+        self.assertEqual(progress, [(done, 10) for done in range(10)])
+
+    def test_client_error_only_fails_its_item(self):
+        def scan_item(item):
+            if item == 'denied':
+                raise ClientError({ 'Error': { 'Code': 'AccessDenied', 'Message': 'no role' } }, 'AssumeRole')
+            return 'ok'
+
+        results = scan_accounts(['a', 'denied', 'b'], scan_item, lambda item, err: err.response['Error']['Code'], 2)
+        self.assertEqual(results, ['ok', 'AccessDenied', 'ok'])
+
+    def test_unexpected_error_drops_the_items_not_started(self):
+        started = []
+
+        def scan_item(item):
+            started.append(item)
+            if item == 0:
+                raise ValueError('unexpected')
+            time.sleep(0.01)
+            return item
+
+        with self.assertRaises(ValueError):
+            scan_accounts(list(range(50)), scan_item, None, 2)
+        # Give any item still running time to finish, nothing else is started
+        time.sleep(0.05)
+        self.assertLess(len(started), 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Tests of scan_journal.py.
+
+    $ python -m unittest discover scripts
+"""
+import os
+import tempfile
+import unittest
+
+from scan_journal import ScanJournal
+
+HEADER = { 'Role': 'Audit', 'Options': ['--roles'] }
+
+class ScanJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'scan.journal')
+
+    def write_scan(self, entries, header=HEADER):
+        journal = ScanJournal(self.path, header=header)
+        for account_id, result, failed in entries:
+            journal.record(account_id, result, failed)
+        journal.close()
+
+    def test_resume_keeps_the_last_result_of_each_account(self):
+        self.write_scan([('1', ['a'], False), ('2', ['b'], True), ('3', ['c'], False), ('3', ['c'], True), ('2', ['b2'], False)])
+        journal = ScanJournal(self.path, resume=True, header=HEADER)
+        journal.close()
+        self.assertEqual(journal.completed, { '1': ['a'], '2': ['b2'] })
+        self.assertEqual(journal.errored, { '3' })
+
+    def test_line_cut_short_is_skipped_and_the_next_entry_starts_a_line(self):
+        self.write_scan([('1', ['a'], False)])
+        with open(self.path, 'a') as f:
+            f.write('{"AccountId": "2", "Sta')
+
+        journal = ScanJournal(self.path, resume=True, header=HEADER)
+        journal.record('2', ['b'], False)
+        journal.close()
+        self.assertEqual(journal.completed, { '1': ['a'] })
+
+        journal = ScanJournal(self.path, resume=True, header=HEADER)
+        journal.close()
+        self.assertEqual(journal.completed, { '1': ['a'], '2': ['b'] })
+
+    def test_refuses_to_resume_with_another_header(self):
+        self.write_scan([('1', ['a'], False)])
+        with self.assertRaises(ValueError):
+            ScanJournal(self.path, resume=True, header={ 'Role': 'Audit', 'Options': [] })
+
+    def test_without_resume_starts_again(self):
+        self.write_scan([('1', ['a'], False)])
+        # Another header is fine when not resuming
+        self.write_scan([], header={ 'Role': 'Other' })
+        journal = ScanJournal(self.path, resume=True, header={ 'Role': 'Other' })
+        journal.close()
+        self.assertEqual((journal.completed, journal.errored), ({}, set()))
+
+    def test_resume_without_a_journal_starts_one(self):
+        journal = ScanJournal(self.path, resume=True, header=HEADER)
+        journal.record('1', ['a'], False)
+        journal.close()
+        journal = ScanJournal(self.path, resume=True, header=HEADER)
+        journal.close()
+        self.assertEqual(journal.completed, { '1': ['a'] })
+
+if __name__ == "__main__":
+    unittest.main()